@@ -1,10 +1,20 @@
 from cvxopt.base import matrix
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from scipy import optimize as op
-import sklearn.cluster as cl
+from scipy import sparse
+
+from array_cache import ArrayCache, fingerprint
+from graph_builder import csr_to_neighbors
+from graph_cache import get_graph_arrays, adjacency_triplets
+from tcrfr_inference import get_neighbor_scores
 
 __author__ = 'nicococo'
 
+# kmeans hotstart clusterings shared by all models (see 'AbstractTCRFR.get_hotstart')
+hotstart_cache = ArrayCache(max_items=8)
+
 
 class AbstractTCRFR(object):
     """ Basic functions for the Transductive Conditional Random Field Regression.
@@ -19,6 +29,7 @@ class AbstractTCRFR(object):
     latent_prev = None   # (#V in {0,...,S-1}) previous latent states
     latent = None        # (#V in {0,...,S-1}) latent states (1-to-1 correspondence to data/labels object)
     latent_fixed = None  # (#V int) '1':corresponding state in 'latent' is fixed
+    latent_warm = False  # 'True': the next map inference starts from 'latent' (set by a 'fit' hotstart)
 
     samples = -1  # (scalar) number of training data samples
     feats = -1    # (scalar) number of features != get_num_dims() !!!
@@ -29,6 +40,7 @@ class AbstractTCRFR(object):
 
     v = None  # parameter vector of the crf (consisting of transition matrices and emission matrices)
     u = None  # parameter vector of the regression part
+    obj = None  # (scalar) objective function value of the best solution found by 'fit'
 
     A = None  # (Nodes x Nodes) = (#V x #V) sparse connectivity matrix (use scipy lil_matrix)
     S = -1    # number of discrete states for each node {0,..,S-1}
@@ -39,6 +51,8 @@ class AbstractTCRFR(object):
     N = None  # matrix of neighbors for each vertex
     N_weights = None
 
+    graph_key = None  # fingerprint of the graph A (see 'graph_cache')
+
     Q = None  # (dims x dims) Crf regularization matrix
 
     trans_sym = None    # (trans_types {0,1} vector) '1':Transition matrix is symmetric,
@@ -59,6 +73,9 @@ class AbstractTCRFR(object):
     trans_d_sym = 0   # (scalar) number of values that need to be stored for a symmetric transition matrix
     trans_d_full = 0  # (scalar) number of values that need to be stored for a full transition matrix
 
+    hotstart_kmeans = 'full'        # kmeans variant used for the hotstart: 'full', 'minibatch' or 'subsample'
+    hotstart_max_samples = 100000   # (scalar) max number of samples clustered by the 'subsample' variant
+    hotstart_use_cache = True       # re-use hotstart clusterings of identical data (see 'hotstart_cache')
 
     def __init__(self, data, labels, label_inds, unlabeled_inds, states, A,
                  reg_theta=0.5, reg_lambda=0.001, reg_gamma=1.0, trans_regs=[1.0], trans_sym=[1]):
@@ -66,58 +83,20 @@ class AbstractTCRFR(object):
         self.A = A
         (verts, foo) = A.size
 
-        # transition types
-        self.trans_n = np.int(max(A))
-
-        # number of states that is used for all transition/emission matrices
-        self.S = states
+        # transition types and number of states that is used for all transition/emission matrices
+        self.init_trans(states, np.int(max(A)), trans_sym, trans_regs)
         self.latent = np.zeros(verts, dtype='i')
         self.latent_prev = np.zeros(verts, dtype='i')
         self.latent_fixed = np.zeros(verts, dtype='i')
 
-        # some transition inits
-        self.trans_d_sym = np.round(self.S * (self.S - 1.) / 2. + self.S)
-        self.trans_d_full = np.round(self.S * self.S)
-        # mark transition matrices as symmetric
-        if len(trans_sym) == 1:
-            self.trans_sym = trans_sym[0]*np.ones(self.trans_n, dtype='i')
-        else:
-            self.trans_sym = trans_sym
-        # transition matrix regularization
-        if len(trans_regs) == 1:
-            self.trans_regs = trans_regs[0]*np.ones(self.trans_n, dtype='i')
-        else:
-            self.trans_regs = trans_regs
-        self.trans_mtx2vec_full, self.trans_mtx2vec_sym, self.trans_vec2vec_mtx = self.get_trans_converters()
-
-        n_sym_mtx = np.sum(self.trans_sym)
-        self.trans_total_dims = np.int(n_sym_mtx * self.trans_d_sym + (self.trans_n - n_sym_mtx) * self.trans_d_full)
-
-        # construct edge matrix
-        num_edges = int((matrix(1.0, (1,A.size[0]))*A*matrix(1.0, (A.size[0],1)))[0]/2)
+        # construct edge matrix and neighbor list for all vertices
+        # (a cache lookup if the same graph was used before)
         self.V = range(verts)
-        idx = 0
-        self.E = np.zeros((num_edges, 2), dtype=np.int)
-        for s in range(verts):
-            for n in range(s, verts):
-                if A[s, n] > 0:
-                    self.E[idx, :] = (s, n)
-                    idx += 1
-
-
-        # neighbor list for all vertices
-        max_conn = max(A*matrix(1.0, (A.size[0],1)))
-
-        print max_conn
-        self.N = np.zeros((len(self.V), max_conn), dtype='i')
-        self.N_weights = np.ones((len(self.V), max_conn), dtype='i')
-        for ind in self.V:
-            ninds = np.where(np.array(matrix(A[ind, :]), dtype='i').reshape(A.size[0]) >= 1)[0]
-            lens = ninds.size
-            self.N[ind, :lens] = ninds
-            if lens < max_conn:
-                self.N[ind, lens:] = 0
-                self.N_weights[ind, lens:] = 0.0
+        self.graph_key, graph = get_graph_arrays(A)
+        self.E = graph['E']
+        self.N = graph['N']
+        self.N_weights = np.array(graph['N_weights'])
+        print self.N.shape[1]
 
         # regularization constants
         self.reg_lambda = reg_lambda
@@ -145,6 +124,28 @@ class AbstractTCRFR(object):
         # print some stats
         self.print_stats()
 
+    def init_trans(self, states, trans_n, trans_sym, trans_regs):
+        self.trans_n = trans_n
+        self.S = states
+
+        # some transition inits
+        self.trans_d_sym = np.round(self.S * (self.S - 1.) / 2. + self.S)
+        self.trans_d_full = np.round(self.S * self.S)
+        # mark transition matrices as symmetric
+        if len(trans_sym) == 1:
+            self.trans_sym = trans_sym[0]*np.ones(self.trans_n, dtype='i')
+        else:
+            self.trans_sym = trans_sym
+        # transition matrix regularization
+        if len(trans_regs) == 1:
+            self.trans_regs = trans_regs[0]*np.ones(self.trans_n, dtype='i')
+        else:
+            self.trans_regs = trans_regs
+        self.trans_mtx2vec_full, self.trans_mtx2vec_sym, self.trans_vec2vec_mtx = self.get_trans_converters()
+
+        n_sym_mtx = np.sum(self.trans_sym)
+        self.trans_total_dims = np.int(n_sym_mtx * self.trans_d_sym + (self.trans_n - n_sym_mtx) * self.trans_d_full)
+
     def print_stats(self):
         # output some stats
         n_sym_mtx = np.sum(self.trans_sym)
@@ -253,11 +254,21 @@ class AbstractTCRFR(object):
         obj = self.reg_lambda / 2.0 * u.dot(u) + y.dot(y) / 2.0 - u.dot(X.T.dot(y)) + u.dot(X.T.dot(X.dot(u))) / 2.0
         return obj, u
 
-    def fit(self, max_iter=50, hotstart=None, use_grads=True):
-        u, v = self.get_hotstart()
+    def em_estimate_u_map(self, phis):
+        # regression m-step given the joint feature maps of the last map inference
+        return self.em_estimate_u(phis[:, self.label_inds].T)
+
+    def fit(self, max_iter=50, hotstart=None, use_grads=True, parallel_msteps=False):
+        self.latent_warm = False
         if hotstart is not None:
             print('Manual hotstart position defined.')
-            u, v = hotstart
+            u, v = hotstart[:2]
+            # optional latent states of a previous solution (start of the first map inference)
+            if len(hotstart) > 2:
+                self.latent = np.array(hotstart[2], dtype=self.latent.dtype).reshape(self.latent.shape)
+                self.latent_warm = True
+        else:
+            u, v = self.get_hotstart()
 
         obj = 1e09
         cnt_iter = 0
@@ -266,42 +277,48 @@ class AbstractTCRFR(object):
         # best objective, u and v
         best_sol = [0, 1e14, None, None, None]
 
-        # terminate if objective function value doesn't change much
-        while cnt_iter < max_iter and not is_converged:
-            # 1. infer the latent states given the current intermediate solutions u and v
-            phis, psi = self.map_inference(u, self.unpack_v(v))
-
-            lats = ''
-            for i in range(self.latent.size):
-                lats += '{0}'.format(self.latent[i])
-                if i in self.label_inds:
-                    lats += '.'
+        # both m-steps only depend on the map inference and can run
+        # concurrently (numpy/scipy release the GIL in the heavy parts)
+        pool = None
+        if parallel_msteps:
+            pool = ThreadPool(processes=2)
+
+        try:
+            # terminate if objective function value doesn't change much
+            while cnt_iter < max_iter and not is_converged:
+                # 1. infer the latent states given the current intermediate solutions u and v
+                phis, psi = self.map_inference(u, self.unpack_v(v))
+
+                if pool is not None:
+                    # 2.+3. dispatch both m-steps and join before the objective check
+                    res_crf = pool.apply_async(self.em_estimate_v, (v, psi), {'use_grads': use_grads})
+                    res_regression = pool.apply_async(self.em_estimate_u_map, (phis, ))
+                    obj_crf, v = res_crf.get()
+                    obj_regression, u = res_regression.get()
                 else:
-                    lats += ' '
-                lats += ' '
-                if i % 50 == 0:
-                    lats += '\n'
- #           print lats
-
-            # 2. solve the crf parameter estimation problem
-            obj_crf, v = self.em_estimate_v(v, psi, use_grads=use_grads)
-            # 3. estimate new regression parameters
-            obj_regression, u = self.em_estimate_u(phis[:, self.label_inds].T)
-            # 4.a. check termination based on objective function progress
-            old_obj = obj
-            obj = self.reg_theta * obj_regression + (1.0 - self.reg_theta) * obj_crf
-            rel = np.abs((old_obj - obj) / obj)
+                    # 2. solve the crf parameter estimation problem
+                    obj_crf, v = self.em_estimate_v(v, psi, use_grads=use_grads)
+                    # 3. estimate new regression parameters
+                    obj_regression, u = self.em_estimate_u_map(phis)
+                # 4.a. check termination based on objective function progress
+                old_obj = obj
+                obj = self.reg_theta * obj_regression + (1.0 - self.reg_theta) * obj_crf
+                rel = np.abs((old_obj - obj) / obj)
 #            print('Iter={0} regr={1:4.2f} crf={2:4.2f}; objective={3:4.2f} rel={4:2.4f} lats={5}'.format(
 #                cnt_iter, obj_regression, obj_crf, obj, rel, np.unique(self.latent).size))
-            if best_sol[1] >= obj:
-                best_sol = [cnt_iter, obj, u, v, self.latent]
+                if best_sol[1] >= obj:
+                    best_sol = [cnt_iter, obj, u, v, self.latent.copy()]
 #                print('*')
-            if cnt_iter > 3 and rel < 0.0001:
-                is_converged = True
-            if np.isinf(obj) or np.isnan(obj):
-                return False
-            cnt_iter += 1
-        iter, _, self.u, self.v, self.latent = best_sol
+                if cnt_iter > 3 and rel < 0.0001:
+                    is_converged = True
+                if np.isinf(obj) or np.isnan(obj):
+                    return False
+                cnt_iter += 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        iter, self.obj, self.u, self.v, self.latent = best_sol
 #        print('Take best solution from iteration {0}/{1}.'.format(iter, cnt_iter-1))
 
         # print
@@ -318,6 +335,94 @@ class AbstractTCRFR(object):
 
         return is_converged
 
+    def fit_path(self, reg_path, max_iter=50, use_grads=True, parallel_msteps=False):
+        """ Fit an ordered sequence of (reg_theta, reg_lambda, reg_gamma) settings.
+            Each fit is warm-started from the previous solution (u, v and latent states,
+            the latter are the icm start of 'TCRFR_Fast'; 'TCRFR_QP' re-solves its qp
+            relaxation and only uses u and v).
+            Returns a list of (reg_params, is_converged, obj, u, v, latent) tuples
+            (obj, u, v and latent are None if the corresponding fit diverged).
+        """
+        sols = []
+        hotstart = None
+        for (reg_theta, reg_lambda, reg_gamma) in reg_path:
+            self.reg_theta = reg_theta
+            self.reg_lambda = reg_lambda
+            self.reg_gamma = reg_gamma
+            self.init_Q()
+
+            self.obj = None
+            is_converged = self.fit(max_iter=max_iter, hotstart=hotstart, use_grads=use_grads,
+                                    parallel_msteps=parallel_msteps)
+            if self.obj is None:
+                # diverged: keep the last valid warm-start
+                sols.append(((reg_theta, reg_lambda, reg_gamma), False, None, None, None, None))
+                continue
+            hotstart = (self.u, self.v, self.latent.copy())
+            sols.append(((reg_theta, reg_lambda, reg_gamma), is_converged, self.obj,
+                         self.u, self.v, self.latent.copy()))
+        return sols
+
+    def fit_restarts(self, n_restarts=8, max_iter=50, round_iter=3, keep_frac=0.5,
+                     use_grads=True, processes=None):
+        """ Random restarts with successive halving: all hotstarts are run for
+            'round_iter' em iterations in a process pool, only the best 'keep_frac'
+            (by objective) are continued until a single run is left which is
+            then finished in this process.
+        """
+        runs = [(seed, None) for seed in np.random.randint(0, 2**31-1, size=n_restarts)]
+        cnt_iter = 0
+        pool = Pool(processes=processes, initializer=_init_restart_worker, initargs=(self, ))
+        try:
+            while len(runs) > 1 and cnt_iter + round_iter < max_iter:
+                jobs = [(seed, hotstart, round_iter, use_grads) for (seed, hotstart) in runs]
+                sols = pool.map(_fit_restart, jobs)
+                cnt_iter += round_iter
+                # keep the best fraction of all runs
+                inds = np.argsort([sol[0] for sol in sols])
+                n_keep = max(1, int(np.ceil(keep_frac*len(runs))))
+                runs = [(runs[i][0], sols[i][1]) for i in inds[:n_keep]]
+                print('Restarts: kept {0} runs after {1} iterations (best objective={2}).'.format(
+                    n_keep, cnt_iter, sols[inds[0]][0]))
+        finally:
+            pool.close()
+            pool.join()
+
+        # finish the surviving run (if the budget was used up, take the best one)
+        seed, hotstart = runs[0]
+        if hotstart is None:
+            np.random.seed(seed)
+            hotstart = self.get_hotstart(use_cache=False)
+        return self.fit(max_iter=max_iter-cnt_iter, hotstart=hotstart, use_grads=use_grads)
+
+    def add_labels(self, indices, values):
+        """ Label the vertices 'indices' (already labeled vertices get the new values).
+            Only label dependent structures are updated (see 'update_labels'), use
+            'refit' to resume em from the current solution.
+        """
+        indices = np.asarray(indices, dtype=self.label_inds.dtype).reshape(-1)
+        values = np.asarray(values).reshape(-1)
+        labels = np.array(self.labels)
+        is_lbl = np.in1d(indices, self.label_inds)
+        if np.any(is_lbl):
+            sorter = np.argsort(self.label_inds)
+            pos = sorter[np.searchsorted(self.label_inds, indices[is_lbl], sorter=sorter)]
+            labels[pos] = values[is_lbl]
+        new_inds = indices[~is_lbl]
+        self.label_inds = np.concatenate((self.label_inds, new_inds))
+        self.labels = np.concatenate((labels, values[~is_lbl]))
+        self.unlabeled_inds = self.unlabeled_inds[~np.in1d(self.unlabeled_inds, new_inds)]
+        self.update_labels(new_inds)
+
+    def update_labels(self, new_inds):
+        # label dependent structures of subclasses (called by 'add_labels')
+        pass
+
+    def refit(self, max_iter=10, use_grads=True, parallel_msteps=False):
+        """ Resume em from the current solution (u, v and latent states), e.g. after 'add_labels'. """
+        return self.fit(max_iter=max_iter, hotstart=(self.u, self.v, self.latent.copy()), use_grads=use_grads,
+                        parallel_msteps=parallel_msteps)
+
     def predict(self, lats=None):
         if lats is None:
             lats = self.latent
@@ -328,6 +433,49 @@ class AbstractTCRFR(object):
             phis[s*self.feats:(s+1)*self.feats, inds] = self.data[:, inds]
         return self.u.dot(phis), lats
 
+    def predict_new(self, data, A, batch_size=100000, max_iter=10, tol=0.001):
+        """ Inductive prediction for new (feats x #V) data with graph A (same edge types
+            as the training graph): icm map inference with the learned crf parameters v
+            (emissions and transitions, no regression term) followed by the regression
+            of the inferred state of each vertex. Vertices are processed in batches of
+            'batch_size', i.e. only neighbor lists and scores of a single batch are held
+            in memory. Returns the predictions and the latent states.
+        """
+        data = np.asarray(data)
+        verts = data.shape[1]
+        rows, cols, vals, _ = adjacency_triplets(A)
+        if vals.size > 0 and np.max(vals) > self.trans_n:
+            raise ValueError('Graph has edge type {0} but the model has only {1} transition types.'.format(
+                int(np.max(vals)), self.trans_n))
+        A = sparse.csr_matrix((vals, (rows, cols)), shape=(verts, verts))
+        vn = self.unpack_v(self.v)
+        u = self.u.reshape((self.feats, self.S), order='F')
+        v_em = vn[int(self.trans_n*self.trans_d_full):].reshape((self.feats, self.S), order='F')
+        batches = [(start, min(start+batch_size, verts)) for start in range(0, verts, batch_size)]
+
+        # start with the best emission states, then icm sweeps over all batches
+        lats = np.zeros(verts, dtype='i')
+        for (start, end) in batches:
+            lats[start:end] = np.argmax(v_em.T.dot(data[:, start:end]), axis=0)
+        iter = 0
+        change = 1.0
+        while change > tol and iter < max_iter:
+            changes = 0
+            for (start, end) in batches:
+                N, N_weights, N_types = csr_to_neighbors(A[start:end, :])
+                scores = v_em.T.dot(data[:, start:end]) + \
+                    get_neighbor_scores(lats, N, N_weights, vn, self.S, self.trans_d_full, N_types)
+                lats_b = np.argmax(scores, axis=0)
+                changes += np.sum(lats[start:end] != lats_b)
+                lats[start:end] = lats_b
+            change = changes/float(verts)
+            iter += 1
+
+        preds = np.zeros(verts)
+        for (start, end) in batches:
+            preds[start:end] = np.sum(u[:, lats[start:end]]*data[:, start:end], axis=0)
+        return preds, lats
+
     def get_joint_feature_maps(self):
         # Regression Joint Feature Map
         phis = np.zeros((self.S*self.feats, self.samples))
@@ -387,13 +535,42 @@ class AbstractTCRFR(object):
 
     solution_latent = None
 
-    def get_hotstart(self):
+    def get_hotstart_clustering(self, use_cache=True):
+        key = fingerprint(self.data, self.S, self.hotstart_kmeans, self.hotstart_max_samples)
+        if use_cache:
+            cached = hotstart_cache.get(key)
+            if cached is not None:
+                return np.array(cached['labels'])
+
+        import sklearn.cluster as cl
+        X = np.asarray(self.data).T
+        if self.hotstart_kmeans == 'minibatch':
+            kmeans = cl.MiniBatchKMeans(n_clusters=self.S, init='random', n_init=10, max_iter=100, tol=0.0001,
+                                        batch_size=min(X.shape[0], 1000))
+            kmeans.fit(X)
+            labels = kmeans.labels_
+        elif self.hotstart_kmeans == 'subsample' and X.shape[0] > self.hotstart_max_samples:
+            # cluster a random subset and assign the remaining samples to the nearest center
+            inds = np.random.permutation(X.shape[0])[:self.hotstart_max_samples]
+            kmeans = cl.KMeans(n_clusters=self.S, init='random', n_init=10, max_iter=100, tol=0.0001)
+            kmeans.fit(X[inds, :])
+            labels = kmeans.predict(X)
+        else:
+            kmeans = cl.KMeans(n_clusters=self.S, init='random', n_init=10, max_iter=100, tol=0.0001)
+            kmeans.fit(X)
+            labels = kmeans.labels_
+
+        if use_cache:
+            hotstart_cache.put(key, {'labels': labels})
+        return np.array(labels)
+
+    def get_hotstart(self, use_cache=None):
+        if use_cache is None:
+            use_cache = self.hotstart_use_cache
         # initialize all non-fixed latent variables with random states
         inds = np.where(self.latent_fixed == 0)[0]
         #self.latent[inds] = np.random.randint(self.S, size=inds.size)
-        kmeans = cl.KMeans(n_clusters=self.S, init='random', n_init=10, max_iter=100, tol=0.0001)
-        kmeans.fit(self.data.T)
-        self.latent = kmeans.labels_
+        self.latent = self.get_hotstart_clustering(use_cache=use_cache)
 
         # self.latent = self.solution_latent
         # print self.latent
@@ -436,3 +613,28 @@ class AbstractTCRFR(object):
 
     def log_partition_derivative(self, v):
         pass
+
+
+# model copy of the pool workers used in 'AbstractTCRFR.fit_restarts'
+_restart_model = None
+
+
+def _init_restart_worker(model):
+    global _restart_model
+    _restart_model = model
+
+
+def _fit_restart(job):
+    # run (or continue) a single restart for a few em iterations
+    seed, hotstart, max_iter, use_grads = job
+    model = _restart_model
+    if hotstart is None:
+        # restarts need distinct clusterings, hence, bypass the hotstart cache
+        np.random.seed(seed)
+        hotstart = model.get_hotstart(use_cache=False)
+    # 'fit' only stores an objective if it did not diverge
+    model.obj = None
+    model.fit(max_iter=max_iter, hotstart=hotstart, use_grads=use_grads)
+    if model.obj is None:
+        return np.inf, hotstart
+    return model.obj, (model.u, model.v)
@@ -0,0 +1,68 @@
+__author__ = 'nicococo'
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+def fingerprint(*args):
+    """ Hex-digest of the content, shape and type of numpy arrays (or cvxopt matrices)
+        and of the representation of plain python values (scalars, strings, tuples).
+    """
+    h = hashlib.sha1()
+    for arg in args:
+        if arg is None or isinstance(arg, (bool, int, float, str, tuple, list)):
+            h.update('{0!r};'.format(arg).encode('utf-8'))
+        else:
+            arr = np.ascontiguousarray(np.asarray(arg))
+            h.update('{0}{1};'.format(arr.dtype.str, arr.shape).encode('utf-8'))
+            h.update(arr.data)
+    return h.hexdigest()
+
+
+class ArrayCache(object):
+    """ Least-recently-used cache for dictionaries of numpy arrays. If 'cache_dir' is
+        set, entries are additionally stored as (uncompressed) .npz-files and re-used
+        across processes and sessions.
+    """
+    max_items = 16      # (scalar) number of entries that are held in memory
+    cache_dir = None    # (string) directory for the .npz-files or None (memory only)
+
+    def __init__(self, max_items=16, cache_dir=None):
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.items = OrderedDict()
+
+    def get_filename(self, key):
+        return os.path.join(self.cache_dir, '{0}.npz'.format(key))
+
+    def get(self, key):
+        if key in self.items:
+            # mark as most recently used
+            arrays = self.items.pop(key)
+            self.items[key] = arrays
+            return arrays
+        if self.cache_dir is not None and os.path.exists(self.get_filename(key)):
+            f = np.load(self.get_filename(key))
+            arrays = dict((name, f[name]) for name in f.files)
+            f.close()
+            self.put(key, arrays, write=False)
+            return arrays
+        return None
+
+    def put(self, key, arrays, write=True):
+        self.items.pop(key, None)
+        self.items[key] = arrays
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+        if write and self.cache_dir is not None:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # write to a temporary file first, other processes might read the cache
+            tmp_name = '{0}.{1}.tmp.npz'.format(self.get_filename(key)[:-4], os.getpid())
+            np.savez(tmp_name, **arrays)
+            os.rename(tmp_name, self.get_filename(key))
+
+    def clear(self):
+        self.items.clear()
@@ -1,25 +1,28 @@
-import matplotlib
-matplotlib.use('QT4Agg')
-# change to type 1 fonts!
-# matplotlib.rcParams['pdf.fonttype'] = 42
-# matplotlib.rcParams['ps.fonttype'] = 42
-import matplotlib.pyplot as plt
+import sys
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 
 import numpy as np
 import cvxopt as co
 import scipy.sparse as sparse
 
-from sklearn.svm import SVR
-from sklearn.metrics import median_absolute_error, \
-    mean_squared_error, r2_score, mean_absolute_error, adjusted_rand_score
-import sklearn.cluster as cl
+from graph_builder import chain_adjacency, khop_adjacency, khop_label_adjacency, combine_adjacency, to_cvxopt
 
-from tcrfr_qp import TCRFR_QP
-from tcrfr_fast import TCRFR_Fast
+# matplotlib, sklearn, mosek and the R bridge are imported by the methods that need them,
+# i.e. headless workers that run only some methods do not pay for (or crash on) them.
 
-from tcrf_regression import TransductiveCrfRegression
-from tcrfr_indep_model import TCrfRIndepModel
-from tcrfr_pair_model import TCrfRPairwisePotentialModel
+
+def get_pyplot(type1_fonts=False):
+    """ pyplot with the qt backend (loaded on the first call, also used by 'regression_methods'). """
+    import matplotlib
+    # the backend can only be selected before pyplot is imported the first time
+    if 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('QT4Agg')
+    if type1_fonts:
+        matplotlib.rcParams['pdf.fonttype'] = 42
+        matplotlib.rcParams['ps.fonttype'] = 42
+    import matplotlib.pyplot as plt
+    return plt
 
 
 def fit_ridge_regression(lam, vecX, vecy):
@@ -59,6 +62,7 @@ def get_1d_toy_data(num_exms=300, plot=False):
     print vecX.shape
     print vecy.shape
     if plot:
+        plt = get_pyplot()
         means = np.ones(vecy.size)
         means[vecz==0] = np.mean(vecX[vecz==0], axis=0)
         means[vecz==1] = np.mean(vecX[vecz==1], axis=0)
@@ -111,6 +115,8 @@ def evaluate(truth, preds, true_lats, lats):
     """ Measure regression performance
     :return: list of error measures and corresponding names
     """
+    from sklearn.metrics import median_absolute_error, \
+        mean_squared_error, r2_score, mean_absolute_error, adjusted_rand_score
     names = list()
     errs = list()
     errs.append(mean_absolute_error(truth, preds))
@@ -140,20 +146,21 @@ def method_transductive_regression(vecX, vecy, train, test, states=2, params=[0.
     XtY = (vecX[train, :].T.dot(vecy[train]))
     w = np.linalg.inv(XXt).dot(XtY.T)
 
-    bak = vecy[test]
-    vecy[test] = w.T.dot(vecX[test, :].T)
+    # (do not overwrite vecy, it might be a read-only shared array)
+    y_test = w.T.dot(vecX[test, :].T)
     # Stage 2: perform global optimization with train + test samples
     C1 = params[1]
     C2 = params[2]
     I = np.identity(vecX.shape[1])
     XXt = I + C1*(vecX[train, :].T.dot(vecX[train, :])) + C2*(vecX[test, :].T.dot(vecX[test, :]))
-    XtY = C1*(vecX[train, :].T.dot(vecy[train])) + C2*(vecX[test, :].T.dot(vecy[test]))
+    XtY = C1*(vecX[train, :].T.dot(vecy[train])) + C2*(vecX[test, :].T.dot(y_test))
     w = np.linalg.inv(XXt).dot(XtY.T)
-    vecy[test] = bak
     return 'Transductive Regression', w.T.dot(vecX[test, :].T).T, np.ones(len(test))
 
 
 def method_tcrfr(vecX, vecy, train, test, states=2, params=[0.9, 0.00001, 0.5], true_latent=None, plot=False):
+    from tcrf_regression import TransductiveCrfRegression
+    from tcrfr_pair_model import TCrfRPairwisePotentialModel
     # model = TCrfRIndepModel(data=vecX.T, labels=vecy[train], label_inds=train, unlabeled_inds=test, states=states)
     A = np.zeros((vecX.shape[0], vecX.shape[0]))
     for i in range(vecX.shape[0]-1):
@@ -189,6 +196,7 @@ def method_tcrfr(vecX, vecy, train, test, states=2, params=[0.9, 0.00001, 0.5],
     print lats
 
     if plot:
+        plt = get_pyplot()
         plt.figure(1)
         plt.subplot(1, 2, 1)
         plt.plot(vecX[:, 0], vecy, '.g', alpha=0.1, markersize=10.0)
@@ -213,16 +221,11 @@ def method_tcrfr(vecX, vecy, train, test, states=2, params=[0.9, 0.00001, 0.5],
 
 
 def method_tcrfr_qp(vecX, vecy, train, test, states=2, params=[0.9, 0.00001, 0.5, 10], true_latent=None, plot=False):
+    from tcrfr_qp import TCRFR_QP
     # model = TCrfRIndepModel(data=vecX.T, labels=vecy[train], label_inds=train, unlabeled_inds=test, states=states)
-    A = co.spmatrix(0.0, range(vecX.shape[0]), range(vecX.shape[0]))
-    for i in range(vecX.shape[0]-1):
-        A[i, i+1] = 1
-        A[i+1, i] = 1
-    for k in range(1,  params[3]):
-        for i in range(vecX.shape[0]-k):
-            if i in train or i+k in train:
-                A[i, i+k] = 1
-                A[i+k, i] = 1
+    # sequence graph plus k-hop edges that touch labeled examples
+    n = vecX.shape[0]
+    A = to_cvxopt(combine_adjacency(chain_adjacency(n), khop_label_adjacency(n, params[3]-1, train)))
 
     tcrfr = TCRFR_QP(data=vecX.T, labels=vecy[train], label_inds=train, unlabeled_inds=test, states=states, A=A,
                   reg_theta=params[0], reg_lambda=params[1], reg_gamma=params[2]*float(len(train)+len(test)),
@@ -233,6 +236,7 @@ def method_tcrfr_qp(vecX, vecy, train, test, states=2, params=[0.9, 0.00001, 0.5
     print lats
 
     if plot:
+        plt = get_pyplot()
         plt.figure(1)
         plt.subplot(1, 2, 1)
         plt.plot(vecX[:, 0], vecy, '.g', alpha=0.1, markersize=10.0)
@@ -256,15 +260,10 @@ def method_tcrfr_qp(vecX, vecy, train, test, states=2, params=[0.9, 0.00001, 0.5
 
 
 def method_tcrfr_pl(vecX, vecy, train, test, states=2, params=[0.9, 0.00001, 0.5, 10], true_latent=None, plot=False):
-    A = co.spmatrix(0.0, range(vecX.shape[0]), range(vecX.shape[0]))
-    for i in range(vecX.shape[0]-1):
-        A[i, i+1] = 1
-        A[i+1, i] = 1
-    for k in range(1, params[3]):
-        for i in range(vecX.shape[0]-k):
-            if i in train or i+k in train:
-                A[i, i+k] = 1
-                A[i+k, i] = 1
+    from tcrfr_fast import TCRFR_Fast
+    # sequence graph plus k-hop edges that touch labeled examples
+    n = vecX.shape[0]
+    A = to_cvxopt(combine_adjacency(chain_adjacency(n), khop_label_adjacency(n, params[3]-1, train)))
 
     tcrfr = TCRFR_Fast(data=vecX.T, labels=vecy[train], label_inds=train, unlabeled_inds=test, states=states, A=A,
                   reg_theta=params[0], reg_lambda=params[1], reg_gamma=params[2]*float(len(train)+len(test)),
@@ -275,6 +274,7 @@ def method_tcrfr_pl(vecX, vecy, train, test, states=2, params=[0.9, 0.00001, 0.5
     print lats
 
     if plot:
+        plt = get_pyplot()
         plt.figure(1)
         plt.subplot(1, 2, 1)
         plt.plot(vecX[:, 0], vecy, '.g', alpha=0.1, markersize=10.0)
@@ -330,6 +330,7 @@ def method_lb(vecX, vecy, train, test, states=2, params=[0.0001], true_latent=No
 
 def method_svr(vecX, vecy, train, test, states=2, params=[1.0, 0.1, 'linear'], true_latent=None, plot=False):
     # train ordinary support vector regression
+    from sklearn.svm import SVR
     if len(params) == 3:
         clf = SVR(C=params[0], epsilon=params[1], kernel=params[2], shrinking=False)
     else:
@@ -339,6 +340,7 @@ def method_svr(vecX, vecy, train, test, states=2, params=[1.0, 0.1, 'linear'], t
 
 
 def method_krr(vecX, vecy, train, test, states=2, params=[0.0001], plot=False):
+    import sklearn.cluster as cl
     feats = vecX.shape[1]
     kmeans = cl.KMeans(n_clusters=states, init='random', n_init=10, max_iter=100, tol=0.0001)
     kmeans.fit(vecX[train, :])
@@ -354,17 +356,10 @@ def method_krr(vecX, vecy, train, test, states=2, params=[0.0001], plot=False):
 
 
 def method_tcrfr_indep(vecX, vecy, train, test, states=2, params=[0.9, 0.00001, 0.4, 100.], true_latent=None, plot=False):
+    from tcrf_regression import TransductiveCrfRegression
+    from tcrfr_indep_model import TCrfRIndepModel
     # A = np.zeros((vecX.shape[0], vecX.shape[0]))
-    A = sparse.lil_matrix((vecX.shape[0], vecX.shape[0]))
-    for i in range(vecX.shape[0]-4):
-        A[i, i+1] = 1
-        A[i+1, i] = 1
-        A[i, i+2] = 1
-        A[i+2, i] = 1
-        A[i, i+3] = 1
-        A[i+3, i] = 1
-        A[i, i+4] = 1
-        A[i+4, i] = 1
+    A = khop_adjacency(vecX.shape[0], 4).tolil()
     print params
     model = TCrfRIndepModel(data=vecX.T, labels=vecy[train], label_inds=train,
                             unlabeled_inds=test, states=states, A=A, lbl_neighbor_gain=params[3])
@@ -374,6 +369,7 @@ def method_tcrfr_indep(vecX, vecy, train, test, states=2, params=[0.9, 0.00001,
     print lats
 
     if plot:
+        plt = get_pyplot()
         plt.figure(1)
         plt.subplot(1, 2, 1)
         plt.plot(vecX[:, 0], vecy, '.g', alpha=0.1, markersize=10.0)
@@ -446,6 +442,7 @@ def method_flexmix(vecX, vecy, train, test, states=2, params=[200, 0.001], true_
         y_pred_flx[i] = y_pred[i, lats_pred[i]-1]
 
     if plot:
+        plt = get_pyplot()
         plt.figure(1)
         plt.subplot(1, 2, 1)
         plt.plot(vecX[:, 0], vecy, '.g', alpha=0.1, markersize=10.0)
@@ -456,18 +453,54 @@ def method_flexmix(vecX, vecy, train, test, states=2, params=[200, 0.001], true_
     return 'FlexMix', np.array(y_pred_flx), np.reshape(lats_pred, newshape=lats_pred.size)
 
 
-def main_run(methods, params, vecX, vecy, vecz, train_frac, val_frac, states, plot):
-    import numpy as np
+def to_shared_array(arr):
+    # copy an array once into shared memory (inherited by the pool workers)
+    arr = np.ascontiguousarray(arr)
+    raw = RawArray('b', max(arr.nbytes, 1))
+    np.frombuffer(raw, dtype=np.int8)[:arr.nbytes] = arr.view(np.int8).reshape(arr.nbytes)
+    return raw, arr.dtype.str, arr.shape
 
-    from sklearn.svm import SVR
-    from sklearn.metrics import median_absolute_error, mean_squared_error, r2_score, mean_absolute_error, adjusted_rand_score
-    from sklearn.datasets import load_svmlight_file
-    import sklearn.cluster as cl
 
-    from tcrf_regression import TransductiveCrfRegression
-    from tcrfr_indep_model import TCrfRIndepModel
-    from tcrfr_pair_model import TCrfRPairwisePotentialModel
+# read-only views of the shared input arrays of the 'main_run' pool workers
+_main_run_data = None
+
+
+def _init_main_run_worker(shared):
+    global _main_run_data
+    _main_run_data = dict()
+    for (name, (raw, dtype, shape)) in shared.items():
+        arr = np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+        arr.flags.writeable = False
+        _main_run_data[name] = arr
+
 
+def _main_run_task(task):
+    (m, p, method, states) = task
+    data = _main_run_data
+    print('Testing parameters {0} for method {1}'.format(p, method))
+    (name, _pred, _lats) = method(data['vecX'], data['vecy'], data['train'], data['test'],
+                                  states=states, params=p, true_latent=data['vecz'], plot=False)
+    return m, p, name, _pred, _lats
+
+
+def normalize_data(vecX, vecy, train, y_scale=20.):
+    """ Center and scale inputs and targets with the statistics of the training samples
+        and append a bias feature. Returns normalized inputs, targets and the
+        normalization constants (e.g. to store them with 'model_io.save_model').
+    """
+    norm = {'x_mean': np.mean(vecX[train, :]), 'y_mean': np.mean(vecy[train])}
+    vecy = vecy-norm['y_mean']
+    vecX = vecX-norm['x_mean']
+    norm['x_scale'] = np.max(np.abs(vecX[train, :]))
+    vecX /= norm['x_scale']
+    # vecX *= 4.
+    norm['y_scale'] = np.max(np.abs(vecy[train]))/y_scale
+    vecy /= norm['y_scale']
+    vecX = np.hstack((vecX, np.ones((vecX.shape[0], 1))))
+    return vecX, vecy, norm
+
+
+def main_run(methods, params, vecX, vecy, vecz, train_frac, val_frac, states, plot, processes=1):
     # generate training samples
     samples = vecX.shape[0]
     inds = np.random.permutation(range(samples))
@@ -477,36 +510,48 @@ def main_run(methods, params, vecX, vecy, vecz, train_frac, val_frac, states, pl
     test = inds[train_nums:]
 
     # normalize data
-    vecy = vecy-np.mean(vecy[train])
-    vecX = vecX-np.mean(vecX[train, :])
-    vecX /= np.max(np.abs(vecX[train, :]))
-    # vecX *= 4.
-    vecy /= np.max(np.abs(vecy[train]))
-    vecy *= 20.
-    vecX = np.hstack((vecX, np.ones((vecX.shape[0], 1))))
+    vecX, vecy, norm = normalize_data(vecX, vecy, train)
 
     names = []
     res = []
     if plot:
+        plt = get_pyplot()
         plt.figure(1)
         plt.plot(vecX[test, 0], vecy[test], 'or', color=[0.3, 0.3, 0.3],  alpha=0.4, markersize=18.0)
     fmts = ['8c', '1m', '2g', '*y', '4k', 'ob', '.r']
-    for m in range(len(methods)):
-        val_error = 1e14
-        pred = None
-        lats = None
-        best_param = None
-        for p in params[m]:
-            print('Testing parameters {0} for method {1}'.format(p, methods[m]))
-            (name, _pred, _lats) = methods[m](np.array(vecX, copy=True), np.array(vecy, copy=True),
-                                            np.array(train, copy=True), np.array(test, copy=True),
-                                            states=states, params=p, true_latent=vecz, plot=False)
-            eval_val, _ = evaluate(vecy[test[:val_nums]], _pred[:val_nums], vecz[test[:val_nums]], _lats[:val_nums])
-            if eval_val[1] < val_error:
-                pred = _pred
-                lats = _lats
-                best_param = p
 
+    # (validation error, name, predictions, latent states, parameters) for each method
+    best = [[1e14, None, None, None, None] for m in range(len(methods))]
+
+    def check_validation(m, p, name, _pred, _lats):
+        eval_val, _ = evaluate(vecy[test[:val_nums]], _pred[:val_nums], vecz[test[:val_nums]], _lats[:val_nums])
+        if eval_val[1] < best[m][0] or best[m][1] is None:
+            best[m] = [eval_val[1], name, _pred, _lats, p]
+
+    if processes > 1:
+        # input arrays are placed once in shared memory instead of being pickled for each task
+        shared = {'vecX': to_shared_array(vecX), 'vecy': to_shared_array(vecy), 'vecz': to_shared_array(vecz),
+                  'train': to_shared_array(train), 'test': to_shared_array(test)}
+        tasks = [(m, p, methods[m], states) for m in range(len(methods)) for p in params[m]]
+        pool = Pool(processes=processes, initializer=_init_main_run_worker, initargs=(shared, ))
+        try:
+            # results come back in task order, i.e. ties are resolved as in the serial loop
+            for (m, p, name, _pred, _lats) in pool.imap(_main_run_task, tasks):
+                check_validation(m, p, name, _pred, _lats)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for m in range(len(methods)):
+            for p in params[m]:
+                print('Testing parameters {0} for method {1}'.format(p, methods[m]))
+                (name, _pred, _lats) = methods[m](np.array(vecX, copy=True), np.array(vecy, copy=True),
+                                                np.array(train, copy=True), np.array(test, copy=True),
+                                                states=states, params=p, true_latent=vecz, plot=False)
+                check_validation(m, p, name, _pred, _lats)
+
+    for m in range(len(methods)):
+        (_, name, pred, lats, best_param) = best[m]
         names.append(name)
         print name
         print 'Best param = ', best_param
@@ -544,6 +589,7 @@ def main_run(methods, params, vecX, vecy, vecz, train_frac, val_frac, states, pl
 
 
 def plot_results(name):
+    plt = get_pyplot()
     f = np.load(name)
     means = f['means']
     stds = f['stds']
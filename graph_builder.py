@@ -0,0 +1,227 @@
+__author__ = 'nicococo'
+import numpy as np
+import scipy.sparse as sparse
+from scipy.spatial import cKDTree
+from cvxopt import spmatrix
+
+
+def from_edges(rows, cols, etypes, verts):
+    """ Symmetric (#V x #V) csr adjacency matrix with the integer edge type of each
+        edge (i, j) as entry. Duplicate edges keep the largest edge type.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    etypes = np.asarray(etypes, dtype=np.int64) * np.ones(rows.size, dtype=np.int64)
+    keys = np.concatenate((rows*verts + cols, cols*verts + rows))
+    etypes = np.concatenate((etypes, etypes))
+    order = np.lexsort((etypes, keys))
+    keys, etypes = keys[order], etypes[order]
+    # the last entry of each key has the largest edge type
+    last = np.ones(keys.size, dtype=bool)
+    last[:-1] = keys[1:] != keys[:-1]
+    keys, etypes = keys[last], etypes[last]
+    return sparse.csr_matrix((etypes.astype(np.float64), (keys // verts, keys % verts)), shape=(verts, verts))
+
+
+def chain_adjacency(verts, etype=1):
+    """ Sequence graph: each vertex i is connected to i+1. """
+    rows = np.arange(verts-1)
+    return from_edges(rows, rows+1, etype, verts)
+
+
+def khop_adjacency(verts, k, etype=1, min_k=1):
+    """ Band graph: each vertex i is connected to i+min_k,...,i+k. """
+    rows = []
+    cols = []
+    for d in range(min_k, k+1):
+        inds = np.arange(max(verts-d, 0))
+        rows.append(inds)
+        cols.append(inds+d)
+    if len(rows) == 0:
+        return from_edges([], [], etype, verts)
+    return from_edges(np.concatenate(rows), np.concatenate(cols), etype, verts)
+
+
+def khop_label_adjacency(verts, k, label_inds, etype=1, min_k=1):
+    """ Band graph restricted to edges (i, i+d), min_k <= d <= k, where i or i+d is labeled. """
+    is_lbl = np.zeros(verts, dtype=bool)
+    is_lbl[np.asarray(label_inds, dtype=np.int64)] = True
+    rows = []
+    cols = []
+    for d in range(min_k, k+1):
+        inds = np.arange(max(verts-d, 0))
+        inds = inds[is_lbl[inds] | is_lbl[inds+d]]
+        rows.append(inds)
+        cols.append(inds+d)
+    if len(rows) == 0:
+        return from_edges([], [], etype, verts)
+    return from_edges(np.concatenate(rows), np.concatenate(cols), etype, verts)
+
+
+def combine_adjacency(*mats):
+    """ Element-wise maximum (i.e. the largest edge type) of several adjacency matrices. """
+    A = sparse.csr_matrix(mats[0])
+    for B in mats[1:]:
+        A = A.maximum(sparse.csr_matrix(B))
+    return A
+
+
+def to_cvxopt(A):
+    """ Convert a scipy sparse adjacency matrix into a cvxopt spmatrix (as used by the TCRFR models). """
+    coo = sparse.coo_matrix(A)
+    return spmatrix(coo.data.astype(np.float64).tolist(), coo.row.tolist(), coo.col.tolist(), coo.shape)
+
+
+def csr_to_neighbors(A):
+    """ Zero-padded neighbor lists N (#V x max degree), neighbor weights (1: valid
+        entry, 0: padding) and the edge type of each neighbor of a scipy sparse
+        adjacency matrix (as used by the pseudo-likelihood/icm functions).
+    """
+    A = sparse.csr_matrix(A)
+    A.sort_indices()
+    verts = A.shape[0]
+    degs = np.diff(A.indptr)
+    max_deg = int(degs.max()) if verts > 0 and A.nnz > 0 else 0
+    rows = np.repeat(np.arange(verts), degs)
+    pos = np.arange(A.nnz) - A.indptr[rows]
+    N = np.zeros((verts, max_deg), dtype='i')
+    N_weights = np.zeros((verts, max_deg), dtype='i')
+    N_types = np.zeros((verts, max_deg), dtype='i')
+    N[rows, pos] = A.indices
+    N_weights[rows, pos] = 1
+    N_types[rows, pos] = A.data
+    return N, N_weights, N_types
+
+
+def get_grid_shape(grid):
+    """ (sizeZ, sizeY, sizeX) of a volume.Vol or of a 2d/3d shape tuple. """
+    if hasattr(grid, 'sizeX'):
+        return int(grid.sizeZ), int(grid.sizeY), int(grid.sizeX)
+    shape = tuple(int(s) for s in grid)
+    if len(shape) == 2:
+        shape = (1, ) + shape
+    return shape
+
+
+def grid_stencil(radius):
+    """ Half-stencil of integer (dz, dy, dx) offsets within the (anisotropic) radius,
+        i.e. each neighbor pair is represented by exactly one offset.
+    """
+    radii = np.ones(3)*radius if np.isscalar(radius) else np.array(radius, dtype=np.float64)
+    steps = np.floor(radii).astype(int)
+    offsets = []
+    for dz in range(0, steps[0]+1):
+        for dy in range(-steps[1], steps[1]+1):
+            for dx in range(-steps[2], steps[2]+1):
+                if (dz, dy, dx) <= (0, 0, 0):
+                    continue
+                dist = 0.0
+                for (d, r) in zip((dz, dy, dx), radii):
+                    if d != 0:
+                        dist += (float(d)/r)**2
+                if dist <= 1.0:
+                    offsets.append((dz, dy, dx))
+    return offsets
+
+
+def grid_radius_adjacency(grid, radius, lateral_etype=1, vertical_etype=None, mask=None):
+    """ Radius neighborhood graph of a regular grid (volume.Vol or (z, y, x) shape).
+        Vertices are numbered as the c-ordered Vol.data array. 'radius' is either a scalar
+        or a (rz, ry, rx) tuple (in voxels) for anisotropic neighborhoods. Edges with a
+        vertical offset get 'vertical_etype' (default: same as 'lateral_etype').
+        With a boolean 'mask' (one entry per grid cell) only edges between masked cells
+        are built and the masked cells are numbered consecutively (in grid order).
+    """
+    if vertical_etype is None:
+        vertical_etype = lateral_etype
+    Z, Y, X = get_grid_shape(grid)
+    inds = np.arange(Z*Y*X).reshape((Z, Y, X))
+    verts = Z*Y*X
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool).reshape((Z, Y, X))
+        verts = int(np.sum(mask))
+        lookup = -np.ones(Z*Y*X, dtype=np.int64)
+        lookup[mask.reshape(-1)] = np.arange(verts)
+    rows = []
+    cols = []
+    etypes = []
+    for (dz, dy, dx) in grid_stencil(radius):
+        if abs(dz) >= Z or abs(dy) >= Y or abs(dx) >= X:
+            # offset is longer than the grid, i.e. there are no such edges
+            continue
+        # all vertices whose shifted neighbor is still inside of the grid
+        box = (slice(max(0, -dz), Z-max(0, dz)), slice(max(0, -dy), Y-max(0, dy)), slice(max(0, -dx), X-max(0, dx)))
+        src = inds[box].reshape(-1)
+        dst = src + dz*Y*X + dy*X + dx
+        if mask is not None:
+            # both ends of the edge need to be masked
+            shifted = (slice(box[0].start+dz, box[0].stop+dz), slice(box[1].start+dy, box[1].stop+dy),
+                       slice(box[2].start+dx, box[2].stop+dx))
+            keep = (mask[box] & mask[shifted]).reshape(-1)
+            src, dst = lookup[src[keep]], lookup[dst[keep]]
+        rows.append(src)
+        cols.append(dst)
+        etypes.append(np.ones(src.size, dtype=np.int64)*(vertical_etype if dz != 0 else lateral_etype))
+    if len(rows) == 0:
+        return from_edges([], [], lateral_etype, verts)
+    return from_edges(np.concatenate(rows), np.concatenate(cols), np.concatenate(etypes), verts)
+
+
+def _kdtree_call(func, X, workers, **kwargs):
+    # parallel queries are 'workers' in recent and 'n_jobs' in older scipy versions
+    try:
+        return func(X, workers=workers, **kwargs)
+    except TypeError:
+        try:
+            return func(X, n_jobs=workers, **kwargs)
+        except TypeError:
+            return func(X, **kwargs)
+
+
+def feature_knn_adjacency(data, k=10, eps=None, mutual=False, etype=2, chunk_size=10000, workers=-1):
+    """ Graph over the columns of the (features x samples) data matrix that connects
+        samples with similar attributes: either the k nearest neighbors or, if 'eps'
+        is set, all neighbors within distance eps. With 'mutual', kNN-edges are only
+        kept if both samples are among the k nearest neighbors of each other.
+        Queries run chunk-wise (bounded memory) on a kd-tree. All edges get 'etype'
+        to distinguish them from spatial neighbors.
+    """
+    X = np.asarray(data, dtype=np.float64).T
+    verts = X.shape[0]
+    tree = cKDTree(X)
+    rows = []
+    cols = []
+    for start in range(0, verts, chunk_size):
+        end = min(start + chunk_size, verts)
+        inds = np.arange(start, end)
+        if eps is not None:
+            nns = _kdtree_call(tree.query_ball_point, X[start:end, :], workers, r=eps)
+            lens = np.array([len(nn) for nn in nns], dtype=np.int64)
+            if lens.sum() == 0:
+                continue
+            n_rows = np.repeat(inds, lens)
+            n_cols = np.concatenate([np.asarray(nn, dtype=np.int64) for nn in nns if len(nn) > 0])
+            keep = n_rows < n_cols
+            rows.append(n_rows[keep])
+            cols.append(n_cols[keep])
+        else:
+            n_k = min(k, verts-1)
+            if n_k < 1:
+                break
+            _, nns = _kdtree_call(tree.query, X[start:end, :], workers, k=n_k+1)
+            nns = nns.reshape(end-start, n_k+1)
+            # remove the sample itself (or the farthest neighbor for duplicates)
+            keep = nns != inds[:, np.newaxis]
+            keep[np.all(keep, axis=1), n_k] = False
+            rows.append(np.repeat(inds, n_k))
+            cols.append(nns[keep])
+
+    if len(rows) == 0:
+        return from_edges([], [], etype, verts)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    if mutual and eps is None:
+        keys = rows*verts + cols
+        keep = np.in1d(keys, cols*verts + rows)
+        rows, cols = rows[keep], cols[keep]
+    return from_edges(rows, cols, etype, verts)
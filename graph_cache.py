@@ -0,0 +1,138 @@
+__author__ = 'nicococo'
+import numpy as np
+from scipy import sparse
+
+from array_cache import ArrayCache, fingerprint
+
+# edge-, neighbor- and qp constraint arrays of all graphs that were used for model
+# construction (set 'graph_cache.cache_dir' to additionally store them as .npz-files)
+graph_cache = ArrayCache(max_items=8)
+
+
+def adjacency_triplets(A):
+    """ Return (rows, cols, values, number of vertices) of all non-zero entries of
+        the adjacency matrix A (cvxopt spmatrix/matrix, scipy sparse or numpy array)
+        sorted by rows and columns.
+    """
+    if sparse.issparse(A):
+        coo = A.tocoo()
+        rows, cols, vals = coo.row, coo.col, coo.data
+        verts = A.shape[0]
+    elif hasattr(A, 'I') and hasattr(A, 'J'):
+        # cvxopt spmatrix
+        rows = np.array(A.I, dtype=np.int64).reshape(-1)
+        cols = np.array(A.J, dtype=np.int64).reshape(-1)
+        vals = np.array(A.V, dtype=np.float64).reshape(-1)
+        verts = A.size[0]
+    else:
+        dense = np.array(A, dtype=np.float64)
+        rows, cols = np.nonzero(dense)
+        vals = dense[rows, cols]
+        verts = dense.shape[0]
+    inds = np.where(vals != 0.0)[0]
+    rows, cols, vals = rows[inds], cols[inds], vals[inds]
+    order = np.lexsort((cols, rows))
+    return rows[order].astype(np.int64), cols[order].astype(np.int64), vals[order].astype(np.float64), verts
+
+
+def build_graph_arrays(rows, cols, vals, verts):
+    """ Edge list E (#edges x 2, each edge (i, j) with i <= j), zero-padded neighbor
+        lists N (#V x max_conn) and neighbor weights (1: valid entry, 0: padding).
+        Triplets need to be sorted by rows and columns.
+    """
+    inds = np.where((rows <= cols) & (vals > 0.0))[0]
+    E = np.zeros((inds.size, 2), dtype=np.int)
+    E[:, 0] = rows[inds]
+    E[:, 1] = cols[inds]
+
+    # max connectivity as the (weighted) row sum of A
+    max_conn = 0
+    if rows.size > 0:
+        max_conn = int(np.max(np.bincount(rows, weights=vals, minlength=verts)))
+    inds = np.where(vals >= 1.0)[0]
+    n_rows = rows[inds]
+    starts = np.concatenate(([0], np.cumsum(np.bincount(n_rows, minlength=verts))[:-1]))
+    pos = np.arange(inds.size) - starts[n_rows]
+    N = np.zeros((verts, max_conn), dtype='i')
+    N_weights = np.zeros((verts, max_conn), dtype='i')
+    N[n_rows, pos] = cols[inds]
+    N_weights[n_rows, pos] = 1
+    return E, N, N_weights
+
+
+def get_graph_arrays(A):
+    """ Cached edge list, neighbor lists and neighbor weights of adjacency matrix A.
+        Returns the key of the graph and a dictionary with read-only arrays.
+    """
+    rows, cols, vals, verts = adjacency_triplets(A)
+    key = fingerprint('graph', verts, rows, cols, vals)
+    arrays = graph_cache.get(key)
+    if arrays is None:
+        E, N, N_weights = build_graph_arrays(rows, cols, vals, verts)
+        arrays = {'E': E, 'N': N, 'N_weights': N_weights}
+        graph_cache.put(key, arrays)
+    for arr in arrays.values():
+        arr.flags.writeable = False
+    return key, arrays
+
+
+def get_label_weights(graph_key, N, N_weights, label_inds, lbl_weight):
+    """ Cached neighbor weights where all (valid) labeled neighbors are set to 'lbl_weight'. """
+    key = fingerprint('label-weights', graph_key, np.sort(label_inds), float(lbl_weight))
+    arrays = graph_cache.get(key)
+    if arrays is None:
+        weights = np.array(N_weights)
+        is_lbl = np.zeros(N.shape[0], dtype=bool)
+        is_lbl[label_inds] = True
+        weights[is_lbl[N] & (N_weights > 0.00001)] = lbl_weight
+        arrays = {'N_weights': weights}
+        graph_cache.put(key, arrays)
+    return np.array(arrays['N_weights'])
+
+
+def build_qp_constraints(E, verts, states):
+    """ Triplets (rows, cols, values) and right-hand side b of the equality constraints
+        of the relaxed map-inference qp: marginalization constraints for each edge and
+        state followed by the normalization constraint of each vertex.
+    """
+    edges = E.shape[0]
+    S = states
+    offset = edges*S*S
+    ks = np.arange(edges)
+    ss = np.arange(S)
+
+    # sum_k x_e(s,k) - x_i(s) = 0
+    rows_a = np.repeat((2*ks*S)[:, None] + ss[None, :], S+1, axis=1).reshape(edges, S, S+1)
+    cols_a = np.zeros((edges, S, S+1), dtype=np.int64)
+    cols_a[:, :, :S] = (ks*S*S)[:, None, None] + ss[None, :, None]*S + ss[None, None, :]
+    cols_a[:, :, S] = offset + E[:, 0][:, None]*S + ss[None, :]
+    # sum_s x_e(s,k) - x_j(k) = 0
+    rows_b = rows_a + S
+    cols_b = np.zeros((edges, S, S+1), dtype=np.int64)
+    cols_b[:, :, :S] = (ks*S*S)[:, None, None] + ss[None, :, None] + ss[None, None, :]*S
+    cols_b[:, :, S] = offset + E[:, 1][:, None]*S + ss[None, :]
+    vals_e = np.ones((edges, S, S+1))
+    vals_e[:, :, S] = -1.0
+
+    # sum_s x_i(s) = 1
+    num_margs = 2*edges*S
+    rows_v = np.repeat(num_margs + np.arange(verts), S)
+    cols_v = offset + np.arange(verts*S)
+
+    rows = np.concatenate((rows_a.reshape(-1), rows_b.reshape(-1), rows_v))
+    cols = np.concatenate((cols_a.reshape(-1), cols_b.reshape(-1), cols_v))
+    vals = np.concatenate((vals_e.reshape(-1), vals_e.reshape(-1), np.ones(verts*S)))
+    b = np.zeros(num_margs + verts)
+    b[num_margs:] = 1.0
+    return rows, cols, vals, b
+
+
+def get_qp_constraints(graph_key, E, verts, states):
+    """ Cached qp equality constraint triplets (see 'build_qp_constraints'). """
+    key = fingerprint('qp-constraints', graph_key, states)
+    arrays = graph_cache.get(key)
+    if arrays is None:
+        rows, cols, vals, b = build_qp_constraints(E, verts, states)
+        arrays = {'rows': rows, 'cols': cols, 'vals': vals, 'b': b}
+        graph_cache.put(key, arrays)
+    return arrays['rows'], arrays['cols'], arrays['vals'], arrays['b']
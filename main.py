@@ -1,3 +1,6 @@
+from method_registry import get_method
+
+
 def generate_param_set(set_name = 'full'):
     param_flx = [[1000, 0.001], [1000, 0.0001]]
     param_rr = [[0.1], [0.01], [0.001], [0.0001], [0.00001], [0.000001]]
@@ -42,35 +45,35 @@ def generate_param_set(set_name = 'full'):
     methods = []
     if set_name == 'full':
         params = [param_rr, param_svr, param_krr, param_tr, param_flx, param_tcrfr_indep, param_tcrfr]
-        methods = [method_rr, method_svr, method_krr,
-                   method_transductive_regression, method_flexmix,
-                   method_tcrfr_indep, method_tcrfr]
+        methods = [get_method('rr'), get_method('svr'), get_method('krr'),
+                   get_method('tr'), get_method('flexmix'),
+                   get_method('tcrfr_indep'), get_method('tcrfr')]
     if 'tcrfr_qp' in set_name:
-        methods.append(method_tcrfr_qp)
+        methods.append(get_method('tcrfr_qp'))
         params.append(param_tcrfr_qp)
     if 'tcrfr_pl' in set_name:
-        methods.append(method_tcrfr_pl)
+        methods.append(get_method('tcrfr_pl'))
         params.append(param_tcrfr_pl)
     if 'tcrfr_indep' in set_name:
-        methods.append(method_tcrfr_indep)
+        methods.append(get_method('tcrfr_indep'))
         params.append(param_tcrfr_indep)
     if 'rr' in set_name:
-        methods.append(method_rr)
+        methods.append(get_method('rr'))
         params.append(param_rr)
     if 'lb' in set_name:
-        methods.append(method_lb)
+        methods.append(get_method('lb'))
         params.append(param_rr)
     if 'svr' in set_name:
-        methods.append(method_svr)
+        methods.append(get_method('svr'))
         params.append(param_svr)
     if 'krr' in set_name:
-        methods.append(method_krr)
+        methods.append(get_method('krr'))
         params.append(param_krr)
     if 'tr' in set_name:
-        methods.append(method_transductive_regression)
+        methods.append(get_method('tr'))
         params.append(param_tr)
     if 'flexmix' in set_name:
-        methods.append(method_flexmix)
+        methods.append(get_method('flexmix'))
         params.append(param_flx)
     return methods, params
 
@@ -78,7 +81,8 @@ def generate_param_set(set_name = 'full'):
 if __name__ == '__main__':
     import argparse, sys
     from gridmap import Job, process_jobs
-    from experiment_toy_seq import *
+    import numpy as np
+    from experiment_toy_seq import get_1d_toy_data, main_run, plot_results
     import logging
     logging.captureWarnings(True)
     logging.basicConfig(format=('%(asctime)s - %(name)s - %(levelname)s - ' +
@@ -126,7 +130,8 @@ if __name__ == '__main__':
             if s not in mse:
                 mse[s] = np.zeros((REPS, MEASURES*len(methods)))
             for n in range(REPS):
-                (names, res) = main_run(methods, params, vecX, vecy, vecz, arguments.train_frac, 0.1, states[s], False)
+                (names, res) = main_run(methods, params, vecX, vecy, vecz, arguments.train_frac, 0.1, states[s], False,
+                                        processes=arguments.processes)
                 perf = mse[s]
                 cnt = 0
                 for p in range(MEASURES):
@@ -0,0 +1,60 @@
+__author__ = 'nicococo'
+import importlib
+
+
+class MethodRef(object):
+    """ Lazy reference to the experiment method 'module.name'. The module is imported
+        on the first call, i.e. referencing (and pickling, e.g. for pool workers) a
+        method does not load its dependencies.
+    """
+    module = None  # name of the module that defines the method
+    name = None  # name of the method function
+
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+
+    def resolve(self):
+        return getattr(importlib.import_module(self.module), self.name)
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __eq__(self, other):
+        return isinstance(other, MethodRef) and (self.module, self.name) == (other.module, other.name)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.module, self.name))
+
+    def __repr__(self):
+        return '{0}.{1}'.format(self.module, self.name)
+
+
+# short names of all experiment methods (see 'main.generate_param_set')
+methods = {
+    'rr': MethodRef('experiment_toy_seq', 'method_rr'),
+    'lb': MethodRef('experiment_toy_seq', 'method_lb'),
+    'svr': MethodRef('experiment_toy_seq', 'method_svr'),
+    'krr': MethodRef('experiment_toy_seq', 'method_krr'),
+    'tr': MethodRef('experiment_toy_seq', 'method_transductive_regression'),
+    'flexmix': MethodRef('experiment_toy_seq', 'method_flexmix'),
+    'tcrfr': MethodRef('experiment_toy_seq', 'method_tcrfr'),
+    'tcrfr_indep': MethodRef('experiment_toy_seq', 'method_tcrfr_indep'),
+    'tcrfr_qp': MethodRef('experiment_toy_seq', 'method_tcrfr_qp'),
+    'tcrfr_pl': MethodRef('experiment_toy_seq', 'method_tcrfr_pl'),
+}
+
+
+def register_method(key, module, name):
+    """ Add (or replace) the method 'module.name' under the short name 'key'. """
+    methods[key] = MethodRef(module, name)
+    return methods[key]
+
+
+def get_method(key):
+    if key not in methods:
+        raise KeyError('Unknown method {0}, registered methods are {1}.'.format(key, sorted(methods.keys())))
+    return methods[key]
@@ -0,0 +1,93 @@
+__author__ = 'nicococo'
+import json
+import struct
+import zipfile
+import numpy as np
+
+from abstract_tcrfr import AbstractTCRFR
+
+# Version of the model file format
+model_version = 1
+
+
+def save_model(model, fname, edge_types=None, norm=None):
+    """ Write everything that is needed for prediction (see 'AbstractTCRFR.predict_new')
+        of a fitted model into an uncompressed .npz-file: u, v, number of states and
+        features, transition types and symmetries, the meaning of each edge type
+        (dictionary, e.g. {1: 'lateral', 2: 'vertical'}) and the normalization
+        constants of the data (dictionary of scalars or arrays, see 'normalize_data').
+    """
+    if edge_types is None:
+        edge_types = {}
+    if norm is None:
+        norm = {}
+    meta = {'version': model_version, 'model': type(model).__name__,
+            'edge_types': dict((str(t), name) for (t, name) in edge_types.items())}
+    arrays = {'meta': np.array(json.dumps(meta)),
+              'u': np.asarray(model.u, dtype=np.float64), 'v': np.asarray(model.v, dtype=np.float64),
+              'states': np.array(model.S), 'feats': np.array(model.feats), 'trans_n': np.array(model.trans_n),
+              'trans_sym': np.asarray(model.trans_sym, dtype='i'),
+              'reg': np.array([model.reg_theta, model.reg_lambda, model.reg_gamma])}
+    for (key, value) in norm.items():
+        arrays['norm_'+key] = np.asarray(value)
+    # np.savez stores the arrays uncompressed, i.e. they can be memory-mapped by 'load_model'
+    np.savez(fname, **arrays)
+
+
+def mmap_npz(fname):
+    """ Dictionary of read-only memory-maps of all arrays of an uncompressed .npz-file. """
+    arrays = {}
+    zf = zipfile.ZipFile(fname, 'r')
+    f = open(fname, 'rb')
+    try:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('Cannot memory-map the compressed member {0}.'.format(info.filename))
+            # the member data starts after the local file header (name and extra field lengths at byte 26)
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if dtype.hasobject or len(shape) == 0 or int(np.prod(shape)) == 0:
+                # (zip members cannot seek in python 2, i.e. read forward only)
+                arrays[name] = np.lib.format.read_array(zf.open(info.filename))
+            else:
+                arrays[name] = np.memmap(fname, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+    finally:
+        f.close()
+        zf.close()
+    return arrays
+
+
+def load_model(fname, mmap=False):
+    """ Model for prediction (see 'AbstractTCRFR.predict_new') from a file written by
+        'save_model'. The model has no training data or graph. Its edge type meaning
+        and normalization constants are in 'edge_types' and 'norm'. With mmap=True
+        u and v are read-only memory-maps of the file.
+    """
+    if mmap:
+        arrays = mmap_npz(fname)
+    else:
+        f = np.load(fname)
+        arrays = dict((name, f[name]) for name in f.files)
+        f.close()
+    meta = json.loads(str(arrays['meta']))
+    if meta['version'] != model_version:
+        raise ValueError('Unsupported model file version {0}.'.format(meta['version']))
+
+    model = AbstractTCRFR.__new__(AbstractTCRFR)
+    model.init_trans(int(arrays['states']), int(arrays['trans_n']), np.array(arrays['trans_sym']), [1.0])
+    model.feats = int(arrays['feats'])
+    model.u = arrays['u']
+    model.v = arrays['v']
+    model.reg_theta, model.reg_lambda, model.reg_gamma = [float(r) for r in arrays['reg']]
+    model.model_name = meta['model']
+    model.edge_types = dict((int(t), name) for (t, name) in meta['edge_types'].items())
+    model.norm = dict((key[5:], arrays[key]) for key in arrays.keys() if key.startswith('norm_'))
+    return model
@@ -1,20 +1,9 @@
-import matplotlib
-matplotlib.use('QT4Agg')
-# change to type 1 fonts!
-matplotlib.rcParams['pdf.fonttype'] = 42
-matplotlib.rcParams['ps.fonttype'] = 42
-import matplotlib.pyplot as plt
-
 import sys
 import numpy as np
 import cvxopt as co
-import pyper as pr
-
-from sklearn.svm import SVR
-from sklearn.metrics import median_absolute_error, \
-    mean_squared_error, r2_score, mean_absolute_error, adjusted_rand_score
-import sklearn.cluster as cl
 
+from experiment_toy_seq import get_pyplot
+from graph_builder import khop_label_adjacency
 from tcrfr_qp import TCRFR_QP
 from tcrfr_fast import TCRFR_Fast
 
@@ -22,12 +11,6 @@ from tcrf_regression import TransductiveCrfRegression
 from tcrfr_indep_model import TCrfRIndepModel
 from tcrfr_pair_model import TCrfRPairwisePotentialModel
 
-import rpy2.robjects as robjects
-import rpy2.rinterface as rinterface
-from rpy2.robjects import pandas2ri
-pandas2ri.activate()
-import pandas as pd
-
 from tcrf_regression import TransductiveCrfRegression
 from tcrfr_indep_model import TCrfRIndepModel
 from tcrfr_pair_model import TCrfRPairwisePotentialModel
@@ -35,8 +18,6 @@ from tcrfr_pair_model import TCrfRPairwisePotentialModel
 #import argparse, sys
 #from gridmap import Job, process_jobs
 
-import pandas as pd
-
 
 def method_ridge_regression(vecX, vecy, train, test, states=2, params=[0.0001]):
     # OLS solution
@@ -77,12 +58,14 @@ def method_transductive_regression(vecX, vecy, train, test, states=2, params=[0.
 
 def method_svr(vecX, vecy, train, test, states=2, params=[1.0, 0.1, 'linear']):
     # train ordinary support vector regression
+    from sklearn.svm import SVR
     clf = SVR(C=params[0], epsilon=params[1], kernel=params[2], shrinking=False)
     clf.fit(vecX[train, :], vecy[train])
     return 'Support Vector Regression', clf.predict(vecX[test, :]), np.ones(len(test))
 
 
 def method_krr(vecX, vecy, train, test, states=2, params=[0.0001]):
+    import sklearn.cluster as cl
     feats = vecX.shape[1]
     kmeans = cl.KMeans(n_clusters=states, init='random', n_init=10, max_iter=100, tol=0.0001)
     kmeans.fit(vecX[train, :])
@@ -99,6 +82,7 @@ def method_krr(vecX, vecy, train, test, states=2, params=[0.0001]):
 
 
 def method_tkrr(vecX, vecy, train, test, states=2, params=[0.0001]):
+    import sklearn.cluster as cl
     feats = vecX.shape[1]
     kmeans = cl.KMeans(n_clusters=states, init='random', n_init=10, max_iter=100, tol=0.0001)
     kmeans.fit(vecX)
@@ -184,6 +168,7 @@ def method_flexmix(vecX, vecy, train, test, states=2, params=[200, 0.001], plot=
     lats[test] = lats_pred
 
     if plot:
+        plt = get_pyplot(type1_fonts=True)
         plt.figure(1)
         plt.subplot(1, 2, 1)
         plt.plot(vecX[:, 0], vecy, '.g', alpha=0.1, markersize=10.0)
@@ -205,6 +190,7 @@ def method_tcrfr_indep(vecX, vecy, train, test, A, states=2, params=[0.9, 0.0000
 #    print lats
 
     if plot:
+        plt = get_pyplot(type1_fonts=True)
         plt.figure(1)
         plt.subplot(1, 2, 1)
         plt.plot(vecX[:, 0], vecy, '.g', alpha=0.1, markersize=10.0)
@@ -235,11 +221,10 @@ def method_tcrfr_v2(vecX, vecy, train, test, A, states=2, params=[0.9, 0.00001,
     #         A[i, i+8] = 1
     #         A[i+8, i] = 1
 
-    for k in range(1,40):
-        for i in range(vecX.shape[0]-k):
-            if i in train or i+k in train:
-                A[i, i+k] = 1
-                A[i+k, i] = 1
+    # k-hop edges (k < 40) that touch labeled examples
+    B = khop_label_adjacency(vecX.shape[0], 39, train).tocoo()
+    for (i, j) in zip(B.row, B.col):
+        A[int(i), int(j)] = 1
 
     # for i in range(vecX.shape[0]-3):
     #     A[i, i+3] = 1
@@ -271,6 +256,7 @@ def method_tcrfr_v2(vecX, vecy, train, test, A, states=2, params=[0.9, 0.00001,
     print lats
 
     if plot:
+        plt = get_pyplot(type1_fonts=True)
         plt.figure(1)
         plt.subplot(1, 2, 1)
         plt.plot(vecX[:, 0], vecy, '.g', alpha=0.1, markersize=10.0)
@@ -309,6 +295,7 @@ def method_tcrfr(vecX, vecy, train, test, A, states=2, params=[0.9, 0.00001, 0.5
     print lats
 
     if plot:
+        plt = get_pyplot(type1_fonts=True)
         plt.figure(1)
         plt.subplot(1, 2, 1)
         plt.plot(vecX[:, 0], vecy, '.g', alpha=0.1, markersize=10.0)
@@ -330,6 +317,8 @@ def evaluate(truth, preds, true_lats, lats):
     """ Measure regression performance
     :return: list of error measures and corresponding names
     """
+    from sklearn.metrics import median_absolute_error, \
+        mean_squared_error, r2_score, mean_absolute_error, adjusted_rand_score
     names = list()
     errs = list()
     errs.append(mean_absolute_error(truth, preds))
@@ -0,0 +1,335 @@
+__author__ = 'nicococo'
+import io
+import json
+import socket
+import struct
+import threading
+import time
+import Queue
+import SocketServer
+import numpy as np
+import scipy.sparse as sparse
+
+from graph_builder import grid_radius_adjacency
+from graph_cache import adjacency_triplets
+from model_io import load_model
+
+
+def send_frame(sock, arrays=None):
+    """ Send a dictionary of arrays as length-prefixed (8 byte, big-endian) .npz-frame.
+        An empty frame (arrays=None) marks the end of a streamed response.
+    """
+    payload = ''
+    if arrays is not None:
+        buf = io.BytesIO()
+        np.savez(buf, **arrays)
+        payload = buf.getvalue()
+    sock.sendall(struct.pack('>Q', len(payload)) + payload)
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 2**20))
+        if not chunk:
+            raise EOFError('Connection closed.')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def recv_frame(sock, max_size=None):
+    """ Receive a length-prefixed .npz-frame, returns None for an empty frame.
+        Frames larger than 'max_size' bytes are refused before reading them.
+    """
+    size = struct.unpack('>Q', recv_exactly(sock, 8))[0]
+    if size == 0:
+        return None
+    if max_size is not None and size > max_size:
+        raise ValueError('Frame of {0} bytes exceeds the limit of {1} bytes.'.format(size, max_size))
+    # frames come from the network, i.e. object arrays (pickles) are refused
+    f = np.load(io.BytesIO(recv_exactly(sock, size)), allow_pickle=False)
+    arrays = dict((name, f[name]) for name in f.files)
+    f.close()
+    return arrays
+
+
+class ScoringJob(object):
+    """ Single scoring request: data and graph of one sub-volume. """
+    model = None    # name of the model
+    data = None     # (feats x #V) data
+    A = None        # (#V x #V) scipy sparse adjacency matrix
+    pred = None     # (#V) predictions
+    latent = None   # (#V) latent states (facies)
+    error = None    # error message if the scoring failed
+
+    def __init__(self, model, data, A):
+        self.model = model
+        self.data = data
+        self.A = A
+        self.done = threading.Event()
+
+
+class Batcher(threading.Thread):
+    """ Coalesces concurrent scoring requests: all jobs arriving within 'max_wait'
+        seconds (up to 'max_verts' vertices) are scored with a single inference call
+        per model on the block-diagonal graph of all of their sub-volumes.
+    """
+
+    def __init__(self, server, max_wait=0.01, max_verts=1000000, batch_size=100000):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = server
+        self.max_wait = max_wait
+        self.max_verts = max_verts
+        self.batch_size = batch_size
+        self.jobs = Queue.Queue()
+
+    def submit(self, job):
+        self.jobs.put(job)
+
+    def run(self):
+        while True:
+            jobs = [self.jobs.get()]
+            verts = jobs[0].data.shape[1]
+            deadline = time.time() + self.max_wait
+            while verts < self.max_verts:
+                try:
+                    jobs.append(self.jobs.get(timeout=max(0.0, deadline - time.time())))
+                except Queue.Empty:
+                    break
+                verts += jobs[-1].data.shape[1]
+            models = {}
+            for job in jobs:
+                models.setdefault(job.model, []).append(job)
+            for (name, group) in models.items():
+                self.score(name, group)
+
+    def score(self, name, jobs):
+        try:
+            model = self.server.models[name]
+            data = np.hstack([job.data for job in jobs])
+            A = sparse.block_diag([job.A for job in jobs], format='csr')
+            preds, lats = model.predict_new(data, A, batch_size=self.batch_size)
+            self.server.record_batch(len(jobs))
+            start = 0
+            for job in jobs:
+                end = start + job.data.shape[1]
+                job.pred, job.latent = preds[start:end], lats[start:end]
+                start = end
+        except Exception as e:
+            for job in jobs:
+                job.error = '{0}: {1}'.format(type(e).__name__, e)
+        for job in jobs:
+            job.done.set()
+
+
+class ScoringHandler(SocketServer.BaseRequestHandler):
+    """ Handles all requests of one connection: a request frame contains the model name,
+        the (feats x #V) data and either the grid shape (z, y, x) of the sub-volume
+        (with radius and edge types of 'grid_radius_adjacency') or the triplets of the
+        adjacency matrix. Latent states and predictions are streamed back in chunks of
+        'chunk_size' vertices followed by an empty frame. A request {'command': 'stats'}
+        returns the server counters. Oversized frames close the connection and requests
+        that are not scored within 'timeout' seconds get an error.
+    """
+
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                req = recv_frame(self.request, max_size=server.max_frame_size)
+            except EOFError:
+                break
+            except ValueError as e:
+                # the payload was not read, i.e. the stream can not be continued
+                send_frame(self.request, {'error': np.array('{0}: {1}'.format(type(e).__name__, e))})
+                send_frame(self.request)
+                break
+            if req is None:
+                continue
+            if 'command' in req and str(req['command']) == 'stats':
+                send_frame(self.request, {'stats': np.array(json.dumps(server.get_stats()))})
+                continue
+
+            start_time = time.time()
+            try:
+                job = ScoringJob(str(req['model']), *server.prepare(req))
+            except Exception as e:
+                send_frame(self.request, {'error': np.array('{0}: {1}'.format(type(e).__name__, e))})
+                send_frame(self.request)
+                continue
+            server.batcher.submit(job)
+            if not job.done.wait(server.timeout):
+                msg = 'Scoring timed out after {0} seconds.'.format(server.timeout)
+                send_frame(self.request, {'error': np.array(msg)})
+            elif job.error is not None:
+                send_frame(self.request, {'error': np.array(job.error)})
+            else:
+                pred, latent = server.postprocess(job.model, job.pred), job.latent
+                for start in range(0, latent.size, server.chunk_size):
+                    end = min(start + server.chunk_size, latent.size)
+                    send_frame(self.request, {'start': np.array(start), 'latent': latent[start:end],
+                                              'pred': pred[start:end]})
+                server.record_request(time.time() - start_time, latent.size)
+            send_frame(self.request)
+
+
+class ScoringServerMixin(SocketServer.ThreadingMixIn):
+    """ Fitted models (see 'model_io.load_model') that are loaded once and a batcher that
+        scores the requests of all connections. Counters are available via 'get_stats'.
+    """
+    daemon_threads = True
+
+    def init_scoring(self, models, max_wait=0.01, max_verts=1000000, batch_size=100000, chunk_size=65536,
+                     max_frame_size=None, timeout=300.0):
+        self.models = models
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        if max_frame_size is None:
+            # 'max_verts' vertices with all features and the triplets of up to 32 edges each (8 bytes
+            # per value) plus some slack for the .npz-headers
+            feats = max([model.feats for model in models.values()] + [1])
+            max_frame_size = max_verts * 8 * (feats + 3*32) + 2**16
+        self.max_frame_size = max_frame_size
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'batches': 0, 'batched_requests': 0, 'voxels': 0,
+                      'latency_sum': 0.0, 'latency_max': 0.0}
+        self.start_time = time.time()
+        self.batcher = Batcher(self, max_wait=max_wait, max_verts=max_verts, batch_size=batch_size)
+        self.batcher.start()
+
+    def prepare(self, req):
+        """ Normalized data and adjacency matrix of a request. """
+        model = self.models[str(req['model'])]
+        data = np.asarray(req['data'], dtype=np.float64)
+        norm = getattr(model, 'norm', {})
+        if 'x_mean' in norm:
+            data = (data - norm['x_mean']) / norm['x_scale']
+        if data.shape[0] == model.feats-1:
+            # bias feature (see 'experiment_toy_seq.normalize_data')
+            data = np.vstack((data, np.ones((1, data.shape[1]))))
+        verts = data.shape[1]
+        if 'grid_shape' in req:
+            vertical_etype = int(req['vertical_etype']) if 'vertical_etype' in req else -1
+            radius = np.asarray(req['radius']) if 'radius' in req else np.array(1.0)
+            radius = float(radius) if radius.ndim == 0 else tuple(radius)
+            A = grid_radius_adjacency(tuple(req['grid_shape']), radius,
+                                      int(req['lateral_etype']) if 'lateral_etype' in req else 1,
+                                      None if vertical_etype < 0 else vertical_etype)
+        else:
+            A = sparse.csr_matrix((req['vals'], (req['rows'], req['cols'])), shape=(verts, verts))
+        if A.shape[0] != verts:
+            raise ValueError('Graph has {0} vertices but data has {1} samples.'.format(A.shape[0], verts))
+        return data, A
+
+    def postprocess(self, name, pred):
+        norm = getattr(self.models[name], 'norm', {})
+        if 'y_scale' in norm:
+            pred = pred * norm['y_scale'] + norm['y_mean']
+        return pred
+
+    def record_batch(self, n_requests):
+        with self.lock:
+            self.stats['batches'] += 1
+            self.stats['batched_requests'] += n_requests
+
+    def record_request(self, latency, voxels):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['voxels'] += voxels
+            self.stats['latency_sum'] += latency
+            self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+
+    def get_stats(self):
+        """ Request, batch and voxel counters, mean/max latency (sec) and throughput. """
+        with self.lock:
+            stats = dict(self.stats)
+        uptime = time.time() - self.start_time
+        stats['uptime'] = uptime
+        stats['latency_mean'] = stats['latency_sum'] / max(stats['requests'], 1)
+        stats['requests_per_batch'] = stats['batched_requests'] / float(max(stats['batches'], 1))
+        stats['voxels_per_sec'] = stats['voxels'] / max(uptime, 1e-9)
+        return stats
+
+
+class ScoringServer(ScoringServerMixin, SocketServer.TCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, address, models, **kwargs):
+        SocketServer.TCPServer.__init__(self, address, ScoringHandler)
+        self.init_scoring(models, **kwargs)
+
+
+class UnixScoringServer(ScoringServerMixin, SocketServer.UnixStreamServer):
+
+    def __init__(self, address, models, **kwargs):
+        SocketServer.UnixStreamServer.__init__(self, address, ScoringHandler)
+        self.init_scoring(models, **kwargs)
+
+
+def serve(address, model_files, **kwargs):
+    """ Load all models ({name: .npz-file}, memory-mapped) and serve requests on a tcp
+        (host, port) or unix socket (path) address until interrupted.
+    """
+    models = dict((name, load_model(fname, mmap=True)) for (name, fname) in model_files.items())
+    if isinstance(address, str):
+        server = UnixScoringServer(address, models, **kwargs)
+    else:
+        server = ScoringServer(address, models, **kwargs)
+    print('Scoring server with models {0} listening on {1}.'.format(models.keys(), address))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def connect(address):
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+def score(address, model, data, grid_shape=None, A=None, radius=1, lateral_etype=1, vertical_etype=None):
+    """ Client: score the (feats x #V) data of a sub-volume with grid shape (z, y, x)
+        or adjacency matrix A. Returns predictions and latent states.
+    """
+    req = {'model': np.array(model), 'data': np.asarray(data, dtype=np.float64)}
+    if grid_shape is not None:
+        req['grid_shape'] = np.array(grid_shape)
+        req['radius'] = np.array(radius)
+        req['lateral_etype'] = np.array(lateral_etype)
+        req['vertical_etype'] = np.array(-1 if vertical_etype is None else vertical_etype)
+    else:
+        req['rows'], req['cols'], req['vals'], _ = adjacency_triplets(A)
+    sock = connect(address)
+    try:
+        send_frame(sock, req)
+        verts = req['data'].shape[1]
+        pred = np.zeros(verts)
+        latent = np.zeros(verts, dtype='i')
+        while True:
+            res = recv_frame(sock)
+            if res is None:
+                break
+            if 'error' in res:
+                raise RuntimeError('Scoring failed: {0}'.format(res['error']))
+            start = int(res['start'])
+            pred[start:start+res['pred'].size] = res['pred']
+            latent[start:start+res['latent'].size] = res['latent']
+    finally:
+        sock.close()
+    return pred, latent
+
+
+def get_server_stats(address):
+    """ Client: counters of a running scoring server. """
+    sock = connect(address)
+    try:
+        send_frame(sock, {'command': np.array('stats')})
+        return json.loads(str(recv_frame(sock)['stats']))
+    finally:
+        sock.close()
@@ -1,3 +1,5 @@
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import scipy.optimize as op
 
@@ -92,16 +94,41 @@ class TransductiveCrfRegression(object):
         print np.unique(structs)
         return vals, structs
 
-    def fit(self, model, max_iter=50, n_init=5, use_grads=True):
-        best_sol = [1e14, None, None, None]
-        for i in range(n_init):
-            self.fit_single_run(model, max_iter=max_iter, use_grads=use_grads)
-            if self.obj < best_sol[0] or i == 0:
-                best_sol = [self.obj, self.u, self.v, model.latent]
-        self.obj, self.u, self.v, model.latent = best_sol
+    def fit(self, model, max_iter=50, n_init=5, use_grads=True, parallel_msteps=False,
+            processes=None, round_iter=3, keep_frac=0.5):
+        """ Random restarts with successive halving (as 'AbstractTCRFR.fit_restarts'):
+            all 'n_init' hotstarts are run for 'round_iter' em iterations in a process
+            pool, only the best 'keep_frac' (by objective) are continued until a single
+            run is left which is then finished in this process.
+        """
+        runs = [(seed, None) for seed in np.random.randint(0, 2**31-1, size=max(1, n_init))]
+        cnt_iter = 0
+        if len(runs) > 1:
+            pool = Pool(processes=processes, initializer=_init_restart_worker, initargs=(self, model))
+            try:
+                while len(runs) > 1 and cnt_iter + round_iter < max_iter:
+                    jobs = [(seed, hotstart, round_iter, use_grads, parallel_msteps) for (seed, hotstart) in runs]
+                    sols = pool.map(_fit_restart, jobs)
+                    cnt_iter += round_iter
+                    # keep the best fraction of all runs
+                    inds = np.argsort([sol[0] for sol in sols])
+                    n_keep = max(1, int(np.ceil(keep_frac*len(runs))))
+                    runs = [(runs[i][0], sols[i][1]) for i in inds[:n_keep]]
+                    print('Restarts: kept {0} runs after {1} iterations (best objective={2}).'.format(
+                        n_keep, cnt_iter, sols[inds[0]][0]))
+            finally:
+                pool.close()
+                pool.join()
+
+        # finish the surviving run (if the budget was used up, take the best one)
+        seed, hotstart = runs[0]
+        if hotstart is None:
+            np.random.seed(seed)
+        self.fit_single_run(model, max_iter=max_iter-cnt_iter, hotstart=hotstart,
+                            use_grads=use_grads, parallel_msteps=parallel_msteps)
         print self.obj
 
-    def fit_single_run(self, model, max_iter=50, hotstart=None, use_grads=True):
+    def fit_single_run(self, model, max_iter=50, hotstart=None, use_grads=True, parallel_msteps=False):
         u, v = model.get_hotstart()
         if hotstart is not None:
             print('Manual hotstart position defined.')
@@ -114,33 +141,76 @@ class TransductiveCrfRegression(object):
         # best objective, u and v
         best_sol = [1e14, None, None]
 
-        # terminate if objective function value doesn't change much
-        while cnt_iter < max_iter and not is_converged:
-            # 1. infer the latent states given the current intermediate solutions u and v
-            vn = model.unpack_param(v)
-            phis, psi = model.maps([self.reg_theta, u, vn])
-
-            # 2. solve the crf parameter estimation problem
-            obj_crf, v = self.estimate_crf_parameters(v, psi, model, use_grads=use_grads)
-
-            # 3. estimate new regression parameters
-            obj_regression, u = self.estimate_regression_parameters(phis.T, model.labels)
-
-            # 4.a. check termination based on objective function progress
-            old_obj = obj
-            obj = self.reg_theta * obj_regression + (1.0 - self.reg_theta) * obj_crf
-            rel = np.abs((old_obj - obj) / obj)
-            print('Iter={0} regr={1:4.2f} crf={2:4.2f}; objective={3:4.2f} rel={4:2.4f} lats={5}'.format(
-                cnt_iter, obj_regression, obj_crf, obj, rel, np.unique(model.latent).size))
-            if best_sol[0] > obj:
-                best_sol = [obj, u, v]
-            if cnt_iter > 3 and rel < 0.0001:
-                is_converged = True
-            if best_sol[0] > obj:
-                best_sol = [obj, u, v]
-            if np.isinf(obj) or np.isnan(obj):
-                return False
-
-            cnt_iter += 1
+        # both m-steps only depend on the map inference and can run
+        # concurrently (numpy/scipy release the GIL in the heavy parts)
+        pool = None
+        if parallel_msteps:
+            pool = ThreadPool(processes=2)
+
+        try:
+            # terminate if objective function value doesn't change much
+            while cnt_iter < max_iter and not is_converged:
+                # 1. infer the latent states given the current intermediate solutions u and v
+                vn = model.unpack_param(v)
+                phis, psi = model.maps([self.reg_theta, u, vn])
+
+                if pool is not None:
+                    # 2.+3. dispatch both m-steps and join before the objective check
+                    res_crf = pool.apply_async(self.estimate_crf_parameters, (v, psi, model), {'use_grads': use_grads})
+                    res_regression = pool.apply_async(self.estimate_regression_parameters, (phis.T, model.labels))
+                    obj_crf, v = res_crf.get()
+                    obj_regression, u = res_regression.get()
+                else:
+                    # 2. solve the crf parameter estimation problem
+                    obj_crf, v = self.estimate_crf_parameters(v, psi, model, use_grads=use_grads)
+
+                    # 3. estimate new regression parameters
+                    obj_regression, u = self.estimate_regression_parameters(phis.T, model.labels)
+
+                # 4.a. check termination based on objective function progress
+                old_obj = obj
+                obj = self.reg_theta * obj_regression + (1.0 - self.reg_theta) * obj_crf
+                rel = np.abs((old_obj - obj) / obj)
+                print('Iter={0} regr={1:4.2f} crf={2:4.2f}; objective={3:4.2f} rel={4:2.4f} lats={5}'.format(
+                    cnt_iter, obj_regression, obj_crf, obj, rel, np.unique(model.latent).size))
+                if best_sol[0] > obj:
+                    best_sol = [obj, u, v]
+                if cnt_iter > 3 and rel < 0.0001:
+                    is_converged = True
+                if best_sol[0] > obj:
+                    best_sol = [obj, u, v]
+                if np.isinf(obj) or np.isnan(obj):
+                    return False
+
+                cnt_iter += 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
         self.obj, self.u, self.v = best_sol
-        return is_converged
\ No newline at end of file
+        return is_converged
+
+
+# regression and model copy of the pool workers used in 'TransductiveCrfRegression.fit'
+_restart_state = None
+
+
+def _init_restart_worker(tcrfr, model):
+    global _restart_state
+    _restart_state = (tcrfr, model)
+
+
+def _fit_restart(job):
+    # run (or continue) a single restart for a few em iterations
+    seed, hotstart, max_iter, use_grads, parallel_msteps = job
+    tcrfr, model = _restart_state
+    if hotstart is None:
+        # the hotstart of 'fit_single_run' is drawn from the seeded generator
+        np.random.seed(seed)
+    # 'fit_single_run' only stores an objective if it did not diverge
+    tcrfr.obj = None
+    tcrfr.fit_single_run(model, max_iter=max_iter, hotstart=hotstart, use_grads=use_grads,
+                         parallel_msteps=parallel_msteps)
+    if tcrfr.obj is None:
+        return np.inf, hotstart
+    return tcrfr.obj, (tcrfr.u, tcrfr.v)
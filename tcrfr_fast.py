@@ -2,11 +2,12 @@ __author__ = 'nicococo'
 import numpy as np
 from cvxopt import matrix, spmatrix, sparse
 import cvxopt.solvers as solver
-import mosek as msk
 
 import scipy.sparse as sparse
 
 from abstract_tcrfr import AbstractTCRFR
+from graph_cache import get_label_weights
+from tcrfr_inference import get_unary_scores, icm, pl_log_partition
 
 class TCRFR_Fast(AbstractTCRFR):
     """ Pairwise Conditional Random Field for transductive regression.
@@ -16,6 +17,7 @@ class TCRFR_Fast(AbstractTCRFR):
     sol_dot_psi = None
 
     fix_lbl_map = False  # fix the labeled data in the inference (only infer once after calling map_inference)?
+    lbl_weight = 1.0     # (scalar) neighbor weight of labeled vertices
 
     def __init__(self, data, labels, label_inds, unlabeled_inds, states, A,
                  reg_theta=0.5, reg_lambda=0.001, reg_gamma=1.0, trans_regs=[1.0, 1.0], trans_sym=[1], lbl_weight=1.0):
@@ -23,56 +25,35 @@ class TCRFR_Fast(AbstractTCRFR):
                  reg_theta, reg_lambda, reg_gamma, trans_regs, trans_sym)
 
         # labeled examples get an extra weight (parameter)
-        for ind in self.V:
-            for i in range(self.N[ind, :].size):
-                if self.N[ind, i] in self.label_inds and self.N_weights[ind, i]>0.00001:
-                    self.N_weights[ind, i] = lbl_weight
+        self.lbl_weight = lbl_weight
+        self.N_weights = get_label_weights(self.graph_key, self.N, self.N_weights, self.label_inds, lbl_weight)
 
 
+    def update_labels(self, new_inds):
+        # only neighbor entries of the new labeled vertices change their weight
+        is_new = np.zeros(self.N.shape[0], dtype=bool)
+        is_new[new_inds] = True
+        self.N_weights[is_new[self.N] & (self.N_weights > 0.00001)] = self.lbl_weight
+
     def map_inference(self, u, vn):
         theta = self.reg_theta
         u = u.reshape((self.feats, self.S), order='F')
         v = vn[self.trans_d_full*self.trans_n:]
         v = v.reshape((self.feats, self.S), order='F')
-        map_objs = np.zeros((self.S, self.samples))
-
-        for s in range(self.S):
-            map_objs[s, :] = (1.0 - theta)*v[:, s].dot(self.data)
-            f_squares = self.labels - u[:, s].dot(self.data[:, self.label_inds])
-            map_objs[s, self.label_inds] -= theta/2. * f_squares*f_squares
+        map_objs = get_unary_scores(self.data, u, v, theta, self.labels, self.label_inds)
 
-        # highest value first
+        # highest value first (unless icm is warm-started with the given latent states)
         if self.latent is not None:
             self.latent_prev = self.latent.copy()
-        self.latent = np.argmax(map_objs, axis=0)
-
-        iter = 0
-        change = 1.0
-        max_iter = 10
-        lats = self.latent.copy()
-        map_objs_bak = map_objs.copy()
-        while change>0.001 and iter<max_iter:
-
-            yn = lats[self.N]
-            for s in range(self.S):
-                add = 0.0
-                for s2 in range(self.S):
-                    n_cnts = np.sum(np.array((yn[:,:] == s2), dtype='d')*self.N_weights[:,:], axis=1)
-                    add += vn[self.trans_mtx2vec_full[s, s2]]*n_cnts
-                map_objs[s, :] += add
-
-            if self.fix_lbl_map:
-                lats_b = np.argmax(map_objs[:, self.unlabeled_inds], axis=0)
-                change = np.sum(lats!=lats_b)/float(lats.size)
-                lats[self.unlabeled_inds] = lats_b
-            else:
-                lats_b = np.argmax(map_objs, axis=0)
-                change = np.sum(lats!=lats_b)/float(lats.size)
-                lats = lats_b
-
-            iter += 1
-            print "(", iter, "): ", change
-            map_objs = map_objs_bak.copy()
+        if not self.latent_warm or self.latent is None:
+            self.latent = np.argmax(map_objs, axis=0)
+        self.latent_warm = False
+
+        update_inds = None
+        if self.fix_lbl_map:
+            update_inds = self.unlabeled_inds
+        lats = icm(map_objs, self.latent, self.N, self.N_weights, vn, self.trans_d_full,
+                   update_inds=update_inds, max_iter=10, tol=0.001, verbose=True)
 
         # highest value first
         if self.latent is not None:
@@ -88,18 +69,8 @@ class TCRFR_Fast(AbstractTCRFR):
 
     def log_partition(self, v):
         # pseudolikelihood approximation = fix the neighbors
-        yn = self.latent[self.N]
-        v_em = v[self.trans_n*self.trans_d_full:].reshape((self.feats, self.S), order='F')
-        f_inner = np.zeros((self.S, self.samples))
-        for s in range(self.S):
-            foo = np.zeros(self.samples)
-            for s2 in range(self.S):
-                n_cnts = np.sum(np.array((yn[:,:] == s2), dtype='d')*self.N_weights[:,:], axis=1)
-                foo += v[self.trans_mtx2vec_full[s, s2]]*n_cnts
-            f_inner[s, :] = v_em[:, s].dot(self.data) + foo
-        max_score = np.max(f_inner)
-        f_inner = np.sum(np.exp(f_inner - max_score), axis=0)
-        foo = np.sum(np.log(f_inner) + max_score)
+        foo = pl_log_partition(self.data, self.latent, self.N, self.N_weights, v,
+                               self.S, self.trans_n, self.trans_d_full)
         if np.isnan(foo) or np.isinf(foo):
             print 'TCRFR Pairwise Potential Model: the log_partition is NAN or INF!!'
         return foo
@@ -0,0 +1,295 @@
+__author__ = 'nicococo'
+from multiprocessing import Pool
+import numpy as np
+
+from graph_builder import grid_radius_adjacency, csr_to_neighbors
+from vol_features import null_value
+
+
+def get_unary_scores(data, u, v_em, theta, labels=None, label_inds=None):
+    """ (S x #V) map inference scores without the neighbor terms: weighted emission
+        scores and, for labeled vertices, the negative squared regression error of
+        each state. 'u' and 'v_em' are (feats x S) matrices.
+    """
+    scores = (1.0 - theta)*v_em.T.dot(data)
+    if labels is not None and len(label_inds) > 0:
+        f_squares = np.asarray(labels)[np.newaxis, :] - u.T.dot(data[:, label_inds])
+        scores[:, label_inds] -= theta/2. * f_squares*f_squares
+    return scores
+
+
+def get_neighbor_counts(lats, N, N_weights, states, N_types=None):
+    """ Dictionary with the (S x #V) weighted counts of the neighbor states of each vertex
+        for each edge type (neighbors with negative (unknown) states are ignored).
+        Without 'N_types' all edges are of type 1.
+    """
+    yn = lats[N]
+    types = [1] if N_types is None else np.unique(N_types[N_weights != 0])
+    cnts = {}
+    for t in types:
+        weights = N_weights if N_types is None else N_weights*(N_types == t)
+        cnts[t] = np.zeros((states, N.shape[0]))
+        for s2 in range(states):
+            cnts[t][s2, :] = np.sum(np.array((yn == s2), dtype='d')*weights, axis=1)
+    return cnts
+
+
+def get_neighbor_scores(lats, N, N_weights, vn, states, trans_d_full, N_types=None):
+    """ (S x #V) sum of the (weighted) transition scores between each state of a vertex
+        and the fixed states 'lats' of its neighbors (see 'get_neighbor_counts').
+    """
+    trans_d_full = int(trans_d_full)
+    scores = np.zeros((states, N.shape[0]))
+    for (t, cnts) in get_neighbor_counts(lats, N, N_weights, states, N_types).items():
+        trans = vn[(t-1)*trans_d_full:t*trans_d_full].reshape((states, states), order='C')
+        scores += trans.dot(cnts)
+    return scores
+
+
+def icm(unary, lats, N, N_weights, vn, trans_d_full, N_types=None, update_inds=None,
+        max_iter=10, tol=0.001, verbose=False):
+    """ Iterated conditional modes starting with 'lats': each iteration sets all vertices
+        in 'update_inds' (default: all) to the best state given the current states of
+        their neighbors. All remaining vertices are fixed. Returns the new states.
+    """
+    states = unary.shape[0]
+    lats = np.array(lats)
+    if update_inds is None:
+        update_inds = np.arange(lats.size)
+    unary = unary[:, update_inds]
+    N = N[update_inds, :]
+    N_weights = N_weights[update_inds, :]
+    if N_types is not None:
+        N_types = N_types[update_inds, :]
+
+    iter = 0
+    change = 1.0
+    while change > tol and iter < max_iter:
+        scores = unary + get_neighbor_scores(lats, N, N_weights, vn, states, trans_d_full, N_types)
+        lats_b = np.argmax(scores, axis=0)
+        change = np.sum(lats[update_inds] != lats_b)/float(lats.size)
+        lats[update_inds] = lats_b
+        iter += 1
+        if verbose:
+            print "(", iter, "): ", change
+    return lats
+
+
+def pl_log_partition(data, lats, N, N_weights, vn, states, trans_n, trans_d_full, N_types=None):
+    """ Pseudo-likelihood approximation of the log-partition function (neighbors are
+        fixed to 'lats').
+    """
+    feats = data.shape[0]
+    v_em = vn[int(trans_n*trans_d_full):].reshape((feats, states), order='F')
+    f_inner = v_em.T.dot(data) + get_neighbor_scores(lats, N, N_weights, vn, states, trans_d_full, N_types)
+    max_score = np.max(f_inner)
+    return np.sum(np.log(np.sum(np.exp(f_inner - max_score), axis=0)) + max_score)
+
+
+def pl_statistics(data, lats, N, N_weights, vn, states, trans_n, trans_d_full, N_types=None):
+    """ Pseudo-likelihood log-partition function (see 'pl_log_partition') and its
+        gradient w.r.t. the unpacked parameter vector 'vn'.
+    """
+    feats = data.shape[0]
+    trans_d_full = int(trans_d_full)
+    offset = int(trans_n)*trans_d_full
+    v_em = vn[offset:].reshape((feats, states), order='F')
+    cnts = get_neighbor_counts(lats, N, N_weights, states, N_types)
+    f_inner = v_em.T.dot(data)
+    for (t, cnt) in cnts.items():
+        f_inner += vn[(t-1)*trans_d_full:t*trans_d_full].reshape((states, states), order='C').dot(cnt)
+    max_score = np.max(f_inner, axis=0)
+    f_inner = np.exp(f_inner - max_score)
+    sum_f = np.sum(f_inner, axis=0)
+    obj = np.sum(np.log(sum_f) + max_score)
+
+    # expected statistics under the state probabilities of each vertex
+    probs = f_inner / sum_f
+    grad = np.zeros(offset + states*feats)
+    for (t, cnt) in cnts.items():
+        grad[(t-1)*trans_d_full:t*trans_d_full] += probs.dot(cnt.T).reshape(-1, order='C')
+    grad[offset:] = data.dot(probs.T).reshape(-1, order='F')
+    return obj, grad
+
+
+def get_tiles(shape, tile_shape, halo):
+    """ Partition of a (z, y, x) grid into tiles. Returns a list of (inner box, outer box,
+        color) where boxes are (z0, z1, y0, y1, x0, x1), the outer box is the inner box
+        plus 'halo' cells (clipped at the grid boundaries) and color (0..7) is the parity
+        of the tile index along each axis. Tiles of the same color do not touch (not even
+        diagonally), i.e. for tile sizes >= halo their inner boxes are outside of each
+        other's halo.
+    """
+    tiles = []
+    for (iz, z0) in enumerate(range(0, shape[0], tile_shape[0])):
+        for (iy, y0) in enumerate(range(0, shape[1], tile_shape[1])):
+            for (ix, x0) in enumerate(range(0, shape[2], tile_shape[2])):
+                inner = (z0, min(z0+tile_shape[0], shape[0]),
+                         y0, min(y0+tile_shape[1], shape[1]),
+                         x0, min(x0+tile_shape[2], shape[2]))
+                outer = []
+                for d in range(3):
+                    outer.append(max(0, inner[2*d]-halo[d]))
+                    outer.append(min(shape[d], inner[2*d+1]+halo[d]))
+                tiles.append((inner, tuple(outer), (iz % 2) + 2*(iy % 2) + 4*(ix % 2)))
+    return tiles
+
+
+class GridTile(object):
+    """ Data, neighbor lists and labels of one tile (inner box plus halo cells) of a grid.
+        Vertices are numbered as the c-ordered outer box. Only inner vertices are
+        updated by the map inference, halo vertices keep the states of the neighbor tiles.
+        Cells that are 'null_value' in any attribute are inactive: their data is zeroed,
+        they have no edges and no labels and keep the state -1.
+    """
+    inner = None        # (z0, z1, y0, y1, x0, x1) inner box in grid coordinates
+    outer = None        # (z0, z1, y0, y1, x0, x1) inner box plus halo in grid coordinates
+    shape = None        # (z, y, x) shape of the outer box
+    data = None         # (feats x #outer) data
+    active = None       # (#outer bool) 'True':cell is not null in any attribute
+    N = None            # neighbor lists, weights and edge types (see 'csr_to_neighbors')
+    N_weights = None
+    N_types = None
+    inner_inds = None   # indices of the active inner vertices
+    label_inds = None   # indices of the labeled vertices (inner and halo)
+    labels = None       # labels of 'label_inds'
+    lats = None         # (#outer) current latent states (-1: unknown)
+
+    def __init__(self, source, inner, outer, radius=1, lateral_etype=1, vertical_etype=None,
+                 label_zyx=None, labels=None, graphs=None):
+        self.inner = inner
+        self.outer = outer
+        self.shape = (outer[1]-outer[0], outer[3]-outer[2], outer[5]-outer[4])
+        self.data = source.readBox(*outer).reshape((-1, int(np.prod(self.shape))))
+        self.active = np.all(self.data > null_value, axis=0)
+        self.data[:, ~self.active] = 0.0
+
+        # neighbor lists only depend on the tile shape ('graphs' caches them across tiles)
+        if graphs is None:
+            graphs = {}
+        if self.shape not in graphs:
+            A = grid_radius_adjacency(self.shape, radius, lateral_etype, vertical_etype)
+            graphs[self.shape] = csr_to_neighbors(A)
+        self.N, N_weights, self.N_types = graphs[self.shape]
+        # no edges from or to inactive cells
+        self.N_weights = N_weights*(self.active[:, np.newaxis] & self.active[self.N])
+
+        update = np.zeros(self.shape, dtype=bool)
+        update[self.get_inner_slices()] = True
+        self.inner_inds = np.where(update.reshape(-1) & self.active)[0]
+
+        # labels inside of the outer box (in tile coordinates)
+        self.label_inds = np.zeros(0, dtype=np.int64)
+        self.labels = np.zeros(0)
+        if labels is not None:
+            z, y, x = label_zyx
+            inds = np.where((z >= outer[0]) & (z < outer[1]) & (y >= outer[2]) & (y < outer[3]) &
+                            (x >= outer[4]) & (x < outer[5]))[0]
+            label_inds = np.ravel_multi_index((z[inds]-outer[0], y[inds]-outer[2], x[inds]-outer[4]), self.shape)
+            keep = self.active[label_inds]
+            self.labels = np.asarray(labels)[inds[keep]]
+            self.label_inds = label_inds[keep]
+        self.lats = -np.ones(self.data.shape[1], dtype=np.int32)
+
+    def get_inner_slices(self):
+        """ Slices of the inner box in (z, y, x) tile coordinates. """
+        return (slice(self.inner[0]-self.outer[0], self.inner[1]-self.outer[0]),
+                slice(self.inner[2]-self.outer[2], self.inner[3]-self.outer[2]),
+                slice(self.inner[4]-self.outer[4], self.inner[5]-self.outer[4]))
+
+    def get_global_inds(self, grid_shape):
+        """ Flat grid indices of all tile vertices. """
+        z, y, x = np.unravel_index(np.arange(self.data.shape[1]), self.shape)
+        return np.ravel_multi_index((z+self.outer[0], y+self.outer[2], x+self.outer[4]), grid_shape)
+
+    def map_inference(self, lats, u, v_em, vn, trans_d_full, theta, max_iter=10):
+        """ Icm of the inner vertices given the (outer box) states 'lats' (-1: unknown,
+            initialized with the best unary state). Returns the inner box states
+            (-1 for inactive cells).
+        """
+        labels = self.labels if self.labels.size > 0 else None
+        unary = get_unary_scores(self.data, u, v_em, theta, labels, self.label_inds)
+        lats = np.array(lats, dtype=np.int32).reshape(-1)
+        lats[~self.active] = -1
+        unknown = np.where((lats < 0) & self.active)[0]
+        lats[unknown] = np.argmax(unary[:, unknown], axis=0)
+        self.lats = icm(unary, lats, self.N, self.N_weights, vn, trans_d_full, self.N_types,
+                        update_inds=self.inner_inds, max_iter=max_iter)
+        return self.lats.reshape(self.shape)[self.get_inner_slices()]
+
+
+# data source, model parameters and neighbor lists (per tile shape) of a tile worker
+_tile_worker = None
+
+
+def _init_tile_worker(source, params):
+    global _tile_worker
+    _tile_worker = {'source': source, 'params': params, 'graphs': {}}
+
+
+def _infer_tile(job):
+    inner, outer, lats = job
+    params = _tile_worker['params']
+    tile = GridTile(_tile_worker['source'], inner, outer, params['radius'], params['lateral_etype'],
+                    params['vertical_etype'], params['label_zyx'], params['labels'], _tile_worker['graphs'])
+    return tile.map_inference(lats, params['u'], params['v_em'], params['vn'], params['trans_d_full'],
+                              params['theta'], max_iter=params['max_iter'])
+
+
+def tiled_map_inference(model, source, radius=1, lateral_etype=1, vertical_etype=None,
+                        tile_shape=(16, 64, 64), halo=None, labels=None, label_inds=None,
+                        latent=None, max_sweeps=4, max_iter=10, tol=0.001, processes=None):
+    """ Icm map inference of a full grid with the parameters (u, v) of a trained
+        model. The data is read tile-wise from 'source' (vol_store.VolStore or
+        vol_features.VolStack) and the grid graph is built per tile (same edge types
+        as used for training, see 'grid_radius_adjacency'). Tiles are processed in
+        a process pool one color at a time (see 'get_tiles'), halo cells are fixed to
+        the states of the neighboring tiles. Null cells (see 'GridTile') are skipped.
+        Optional labels (flat grid indices) add the regression term with the model's
+        reg_theta. Returns the (z, y, x) latent states (-1 for null cells, or None if
+        'source' is empty).
+    """
+    shape = tuple(source.shape)
+    if np.prod(shape) == 0:
+        return None
+    if halo is None:
+        halo = int(np.ceil(np.max(radius)))
+    if np.isscalar(halo):
+        halo = (halo, halo, halo)
+    vn = model.unpack_v(model.v)
+    params = {'u': model.u.reshape((model.feats, model.S), order='F'),
+              'v_em': vn[int(model.trans_n*model.trans_d_full):].reshape((model.feats, model.S), order='F'),
+              'vn': vn, 'trans_d_full': model.trans_d_full, 'theta': 0.0, 'max_iter': max_iter,
+              'radius': radius, 'lateral_etype': lateral_etype, 'vertical_etype': vertical_etype,
+              'labels': None, 'label_zyx': None}
+    if labels is not None:
+        params['theta'] = model.reg_theta
+        params['labels'] = np.asarray(labels, dtype=np.float64)
+        params['label_zyx'] = np.unravel_index(np.asarray(label_inds, dtype=np.int64), shape)
+
+    # unknown states (-1) are initialized with the unary scores of the first tile visiting them
+    if latent is None:
+        latent = -np.ones(shape, dtype=np.int32)
+    tiles = get_tiles(shape, tile_shape, halo)
+    pool = Pool(processes=processes, initializer=_init_tile_worker, initargs=(source, params))
+    try:
+        for sweep in range(max_sweeps):
+            changes = 0
+            for color in sorted(set(c for (_, _, c) in tiles)):
+                jobs = [(inner, outer) for (inner, outer, c) in tiles if c == color]
+                # all tiles of one color see the same states, updates are written afterwards
+                results = pool.map(_infer_tile, [(inner, outer, latent[outer[0]:outer[1], outer[2]:outer[3],
+                                                                       outer[4]:outer[5]].copy())
+                                                 for (inner, outer) in jobs])
+                for ((inner, outer), lats) in zip(jobs, results):
+                    box = latent[inner[0]:inner[1], inner[2]:inner[3], inner[4]:inner[5]]
+                    changes += np.sum(box != lats)
+                    box[:] = lats
+            change = changes/float(latent.size)
+            print('Tiled inference: sweep {0} changed {1:2.4f} of all states.'.format(sweep, change))
+            if change < tol:
+                break
+    finally:
+        pool.close()
+        pool.join()
+    return latent
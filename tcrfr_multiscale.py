@@ -0,0 +1,98 @@
+__author__ = 'nicococo'
+import numpy as np
+
+from graph_builder import to_cvxopt
+from vol_features import ActiveCells, null_value
+from volume import Vol
+
+
+def downsample_vol(vol, factors=(1, 2, 2)):
+    """ Block average of a volume with (z, y, x) block sizes 'factors'. Null voxels are
+        ignored, blocks without any valid voxel are null. Partial blocks at the upper
+        boundaries are averaged over their valid voxels.
+    """
+    fz, fy, fx = factors
+    Z, Y, X = vol.data.shape
+    nz, ny, nx = -(-Z // fz), -(-Y // fy), -(-X // fx)
+    sums = np.zeros((nz*fz, ny*fy, nx*fx))
+    counts = np.zeros((nz*fz, ny*fy, nx*fx))
+    valid = vol.data > null_value
+    sums[:Z, :Y, :X] = np.where(valid, vol.data, 0.0)
+    counts[:Z, :Y, :X] = valid
+    sums = sums.reshape((nz, fz, ny, fy, nx, fx)).sum(axis=(1, 3, 5))
+    counts = counts.reshape((nz, fz, ny, fy, nx, fx)).sum(axis=(1, 3, 5))
+    data = np.where(counts > 0, sums / np.maximum(counts, 1.0), null_value)
+    res = Vol()
+    res.load(nx, ny, nz, vol.originX, vol.originY, vol.originZ,
+             vol.stepX*fx, vol.stepY*fy, vol.stepZ*fz, vol.rotation, data, copy=False)
+    return res
+
+
+def build_pyramid(vols, levels=3, factors=(1, 2, 2)):
+    """ List of 'levels' lists of aligned volumes, from the original (finest) volumes
+        to the coarsest level. Each level is block averaged with 'factors'.
+    """
+    pyramid = [list(vols)]
+    for level in range(1, levels):
+        pyramid.append([downsample_vol(vol, factors) for vol in pyramid[-1]])
+    return pyramid
+
+
+def upsample_latent(latent, shape, factors=(1, 2, 2)):
+    """ Nearest neighbor upsampling of a (z, y, x) latent state map to grid 'shape'. """
+    res = latent
+    for (axis, f) in enumerate(factors):
+        res = np.repeat(res, f, axis=axis)
+    return res[:shape[0], :shape[1], :shape[2]]
+
+
+def coarsen_labels(label_inds, labels, fine_shape, coarse_shape, factors=(1, 2, 2)):
+    """ Labels (flat grid indices and values) of a coarser level: labels within the
+        same block are averaged.
+    """
+    z, y, x = np.unravel_index(np.asarray(label_inds, dtype=np.int64), fine_shape)
+    inds = np.ravel_multi_index((z // factors[0], y // factors[1], x // factors[2]), coarse_shape)
+    coarse_inds, pos = np.unique(inds, return_inverse=True)
+    sums = np.bincount(pos, weights=np.asarray(labels, dtype=np.float64))
+    return coarse_inds, sums / np.bincount(pos)
+
+
+def fit_multiscale(vols, label_inds, labels, make_model, levels=3, factors=(1, 2, 2), radius=1,
+                   lateral_etype=1, vertical_etype=None, max_iter=50, fine_iter=3, use_grads=True):
+    """ Coarse-to-fine fit of a TCRFR model on a stack of aligned volumes with labels at
+        flat grid indices 'label_inds'. The coarsest level of a block averaged pyramid
+        is fitted from scratch, each finer level is hotstarted with u, v and the
+        upsampled latent states of the previous level (start of the first icm of
+        'TCRFR_Fast.map_inference') and runs 'fine_iter' em iterations only. Null voxels are excluded (see 'vol_features.ActiveCells').
+        'make_model(data, labels, label_inds, unlabeled_inds, A)' constructs the model
+        of one level, e.g. 'lambda *args: TCRFR_Fast(*args[:4], states=3, A=args[4])'.
+        Returns the model of each level (finest first) and their active cells.
+    """
+    pyramid = build_pyramid(vols, levels, factors)
+    shapes = [level[0].data.shape for level in pyramid]
+    level_labels = [(np.asarray(label_inds, dtype=np.int64), np.asarray(labels, dtype=np.float64))]
+    for level in range(1, levels):
+        level_labels.append(coarsen_labels(level_labels[-1][0], level_labels[-1][1],
+                                           shapes[level-1], shapes[level], factors))
+
+    models = [None]*levels
+    cells = [ActiveCells(level) for level in pyramid]
+    hotstart = None
+    for level in range(levels-1, -1, -1):
+        data = cells[level].get_data(pyramid[level])
+        A = cells[level].get_grid_adjacency(shapes[level], radius, lateral_etype, vertical_etype)
+        lbl_inds, lbls = cells[level].restrict_labels(*level_labels[level])
+        model = make_model(data, lbls, lbl_inds, cells[level].get_unlabeled_inds(lbl_inds), to_cvxopt(A))
+        print('Multiscale: level {0} with {1} active cells.'.format(level, data.shape[1]))
+        if hotstart is None:
+            model.fit(max_iter=max_iter, use_grads=use_grads)
+        else:
+            model.fit(max_iter=fine_iter, hotstart=hotstart, use_grads=use_grads)
+        models[level] = model
+
+        if level > 0:
+            # latent states of the next finer level
+            latent = cells[level].scatter(model.latent, fill=0).reshape(shapes[level])
+            latent = upsample_latent(latent, shapes[level-1], factors).reshape(-1)
+            hotstart = (model.u, model.v, latent[cells[level-1].inds])
+    return models, cells
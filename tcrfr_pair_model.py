@@ -2,7 +2,6 @@ __author__ = 'nicococo'
 import numpy as np
 from cvxopt import matrix, spmatrix, sparse
 import cvxopt.solvers as solver
-import mosek as msk
 from structured_object import TransductiveStructuredModel
 
 
@@ -318,6 +317,8 @@ class TCrfRPairwisePotentialModel(TransductiveStructuredModel):
         # convert u to Q
         P, q = self.get_qp_params(u, v, theta)
 
+        # mosek is only needed (and loaded) when a qp is solved
+        import mosek as msk
         solver.options['MOSEK'] = {msk.iparam.log: 0}
         solution = solver.qp(P, q, G, h, A, b, solver='mosek')
         res = solution['x']
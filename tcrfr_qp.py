@@ -4,9 +4,9 @@ __author__ = 'nicococo'
 import numpy as np
 from cvxopt import matrix, spmatrix, sparse
 import cvxopt.solvers as solver
-import mosek as msk
 
 from abstract_tcrfr import AbstractTCRFR
+from graph_cache import get_qp_constraints
 
 class TCRFR_QP(AbstractTCRFR):
     """ Pairwise Conditional Random Field for transductive regression.
@@ -34,6 +34,8 @@ class TCRFR_QP(AbstractTCRFR):
         # highest value first
         if self.latent is not None:
             self.latent_prev = self.latent
+        # the qp relaxation has no start point, i.e. warm-start latent states are not used
+        self.latent_warm = False
         self.latent = self.qp_relax_max(u, v, theta)
         self.phis, self.psi = self.get_joint_feature_maps()
         return self.phis, self.psi
@@ -187,38 +189,13 @@ class TCRFR_QP(AbstractTCRFR):
         states = self.S
         edges = len(self.E)
         dims = edges*states*states + len(self.V)*states
-        offset = edges*states*states
         print('Init constraint matrices for relaxed QP with {0} marginal and {1} vertex constraints.'.format(2*edges*states, len(self.V)))
         num_constr = 2*edges*states + len(self.V)
-        A = spmatrix([0.0],[0],[0],(num_constr, dims))
-        b = matrix(0.0, (num_constr, 1))
-        row = 0
-        cnt = 0
-        # pair-wise potentials
-        for e in self.E:
-            ind_i = e[0]
-            ind_j = e[1]
-            for s in range(states):
-                for k in range(states):
-                    A[row, cnt + s*states + k] = 1.0
-                A[row, offset + ind_i*states + s] = -1.0
-                row += 1
-            for k in range(states):
-                for s in range(states):
-                    A[row, cnt + k + s*states] = 1.0
-                A[row, offset + ind_j*states + k] = -1.0
-                row += 1
-            cnt += states*states
-        num_margs = row
-        # emissions
-        for v in self.V:
-            # emission constraints: sum_s x_is = 1
-            A[row, offset:offset + states] = 1.0
-            b[row] = 1.0
-            row += 1
-            offset += states
-        self.qp_eq_A = A
-        self.qp_eq_b = b
+        num_margs = 2*edges*states
+        # pair-wise marginalization and vertex constraints (cached for identical graphs)
+        rows, cols, vals, b = get_qp_constraints(self.graph_key, self.E, len(self.V), states)
+        self.qp_eq_A = spmatrix(vals.tolist(), rows.tolist(), cols.tolist(), (num_constr, dims))
+        self.qp_eq_b = matrix(b.tolist(), (num_constr, 1))
         # lower bounds
         self.qp_ineq_G = spmatrix(-1.0, range(dims), range(dims))
         self.qp_ineq_h = matrix(0.0, (dims, 1))
@@ -240,6 +217,8 @@ class TCRFR_QP(AbstractTCRFR):
         # convert u to Q
         P, q = self.get_qp_params(u, v, theta)
 
+        # mosek is only needed (and loaded) when a qp is solved
+        import mosek as msk
         solver.options['MOSEK'] = {msk.iparam.log: 0}
         solution = solver.qp(P, q, G, h, A, b, solver='mosek')
         res = solution['x']
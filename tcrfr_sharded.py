@@ -0,0 +1,302 @@
+__author__ = 'nicococo'
+import os
+from multiprocessing import Process
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+from abstract_tcrfr import AbstractTCRFR
+from tcrfr_inference import GridTile, get_tiles, pl_statistics
+from vol_store import VolStore
+
+
+def get_shard_statistics(tile, grid_shape, states, trans_n, trans_d_full):
+    """ Sufficient statistics of the (active) inner vertices of a tile given its current states:
+        the part of the crf joint feature map (emissions of the inner vertices and
+        transitions of all edges (i, j) where i is an inner vertex and has the smaller
+        grid index) and the regression statistics of the inner labeled vertices
+        (per state XtX (S x F x F) and Xty (S x F), yty and number of labels).
+    """
+    feats = tile.data.shape[0]
+    trans_d_full = int(trans_d_full)
+    offset = int(trans_n)*trans_d_full
+    inner = tile.inner_inds
+    lats = tile.lats
+
+    psi = np.zeros(offset + states*feats)
+    # transitions (each edge is counted once)
+    glob = tile.get_global_inds(grid_shape)
+    N = tile.N[inner, :]
+    own = (tile.N_weights[inner, :] != 0) & (glob[inner][:, np.newaxis] < glob[N])
+    idx = (tile.N_types[inner, :]-1)*trans_d_full + lats[inner][:, np.newaxis]*states + lats[N]
+    psi[:offset] = np.bincount(idx[own], minlength=offset)
+    # emissions
+    for s in range(states):
+        inds = inner[lats[inner] == s]
+        psi[offset+s*feats:offset+(s+1)*feats] = np.sum(tile.data[:, inds], axis=1)
+
+    # regression statistics
+    is_inner = np.zeros(tile.data.shape[1], dtype=bool)
+    is_inner[inner] = True
+    keep = is_inner[tile.label_inds]
+    label_inds = tile.label_inds[keep]
+    labels = tile.labels[keep]
+    XtX = np.zeros((states, feats, feats))
+    Xty = np.zeros((states, feats))
+    for s in range(states):
+        inds = np.where(lats[label_inds] == s)[0]
+        X = tile.data[:, label_inds[inds]]
+        XtX[s, :, :] = X.dot(X.T)
+        Xty[s, :] = X.dot(labels[inds])
+    return psi, XtX, Xty, labels.dot(labels), labels.size
+
+
+def run_shard_worker(address, authkey, source=None):
+    """ Shard worker: connects to the coordinator (see 'ShardedTCRFR') at 'address'
+        and answers its requests until it is closed. Can be started on any machine
+        that can open the store path of the coordinator (with its authkey). Local
+        workers of in-memory data sources get the 'source' itself.
+    """
+    conn = Client(address, authkey=authkey)
+    tile = None
+    cfg = None
+    while True:
+        msg = conn.recv()
+        cmd = msg[0]
+        if cmd == 'init':
+            _, path, inner, outer, cfg = msg
+            if path is not None:
+                source = VolStore(path)
+            tile = GridTile(source, inner, outer, cfg['radius'], cfg['lateral_etype'], cfg['vertical_etype'],
+                            cfg['label_zyx'], cfg['labels'])
+            conn.send((tile.data.shape[0], tile.inner_inds.size))
+        elif cmd == 'sample':
+            # random (active) inner vertices for the kmeans hotstart
+            _, n, seed = msg
+            rand = np.random.RandomState(seed)
+            inds = tile.inner_inds[rand.permutation(tile.inner_inds.size)[:n]]
+            conn.send(tile.data[:, inds].T)
+        elif cmd == 'assign':
+            # nearest cluster center
+            _, centers = msg
+            dists = np.sum(tile.data*tile.data, axis=0)[np.newaxis, :] \
+                - 2.0*centers.dot(tile.data) + np.sum(centers*centers, axis=1)[:, np.newaxis]
+            tile.lats = np.argmin(dists, axis=0).astype(np.int32)
+            tile.lats[~tile.active] = -1
+            conn.send(tile.lats.reshape(tile.shape)[tile.get_inner_slices()])
+        elif cmd == 'map':
+            _, lats, u, vn, theta = msg
+            feats = tile.data.shape[0]
+            u = u.reshape((feats, cfg['states']), order='F')
+            v_em = vn[int(cfg['trans_n']*cfg['trans_d_full']):].reshape((feats, cfg['states']), order='F')
+            conn.send(tile.map_inference(lats, u, v_em, vn, cfg['trans_d_full'], theta, max_iter=cfg['max_iter']))
+        elif cmd == 'stats':
+            _, lats = msg
+            tile.lats = np.array(lats, dtype=np.int32).reshape(-1)
+            conn.send(get_shard_statistics(tile, cfg['grid_shape'], cfg['states'], cfg['trans_n'],
+                                           cfg['trans_d_full']))
+        elif cmd == 'pl':
+            _, vn = msg
+            inner = tile.inner_inds
+            conn.send(pl_statistics(tile.data[:, inner], tile.lats, tile.N[inner, :], tile.N_weights[inner, :],
+                                    vn, cfg['states'], cfg['trans_n'], cfg['trans_d_full'], tile.N_types[inner, :]))
+        elif cmd == 'close':
+            break
+    conn.close()
+
+
+class ShardedTCRFR(AbstractTCRFR):
+    """ Transductive crf regression of a full grid with sufficient statistics EM.
+        The grid is split into spatial shards (with halo cells) and each shard is
+        owned by a worker process that holds its data and neighbor lists. Workers
+        do the icm map inference of their shard (one shard color at a time, halo
+        cells are fixed to the neighbor shard states) and return pseudo-likelihood
+        objective/gradient contributions and regression statistics. Null cells are
+        excluded (see 'tcrfr_inference.GridTile'). The coordinator only keeps the
+        (z, y, x) latent states (-1 for null cells) and solves both m-steps on the
+        reduced statistics.
+        Workers connect via multiprocessing.connection, i.e. a socket 'address'
+        that can also be reached from other machines (see 'run_shard_worker').
+        Workers only get the store path of the data, remote workers need a
+        vol_store.VolStore source and an explicit (secret) authkey.
+    """
+    source = None       # data source with readBox (vol_store.VolStore or its path, or vol_features.VolStack)
+    shards = None       # list of (inner box, outer box, color) (see 'get_tiles')
+    shard_sizes = None  # number of active inner cells of each shard
+    conns = None        # connection to the worker of each shard
+    workers = None      # locally started worker processes
+    listener = None
+    address = None      # address of the coordinator
+
+    stats_regression = None  # reduced (XtX, Xty, yty) of the last map inference
+    pl_cache = None          # (vn, obj, grad) of the last pseudo-likelihood evaluation
+
+    def __init__(self, source, labels, label_inds, states, radius=1, lateral_etype=1, vertical_etype=None,
+                 shard_shape=(32, 128, 128), reg_theta=0.5, reg_lambda=0.001, reg_gamma=1.0,
+                 trans_regs=[1.0], trans_sym=[1], address=('localhost', 0), authkey=None,
+                 spawn_workers=True, max_iter=10):
+        # no call of 'AbstractTCRFR.__init__': data and graph are never held by the coordinator
+        if isinstance(source, str):
+            source = VolStore(source)
+        self.source = source
+        # workers open stores themselves, other sources are only inherited by local workers
+        path = source.path if isinstance(source, VolStore) else None
+        if not spawn_workers:
+            if authkey is None:
+                raise ValueError('Remote shard workers need an explicit authkey.')
+            if path is None:
+                raise ValueError('Remote shard workers need a vol_store.VolStore (or its path) as data source.')
+        if authkey is None:
+            # only known to the locally started workers
+            authkey = os.urandom(16)
+        shape = tuple(source.shape)
+        if vertical_etype is None:
+            vertical_etype = lateral_etype
+        self.init_trans(states, int(max(lateral_etype, vertical_etype)), trans_sym, trans_regs)
+        self.latent = -np.ones(shape, dtype=np.int32)
+
+        self.reg_lambda = reg_lambda
+        self.reg_gamma = reg_gamma
+        self.reg_theta = reg_theta
+        self.labels = np.array(labels, dtype=np.float64)
+        self.label_inds = np.array(label_inds, dtype=np.int64)
+
+        # start the workers and send each one its shard
+        halo = int(np.ceil(np.max(radius)))
+        self.shards = get_tiles(shape, shard_shape, (halo, halo, halo))
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.workers = []
+        if spawn_workers:
+            for i in range(len(self.shards)):
+                worker = Process(target=run_shard_worker, args=(self.address, authkey, None if path is not None else source))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        cfg = {'radius': radius, 'lateral_etype': lateral_etype, 'vertical_etype': vertical_etype,
+               'label_zyx': np.unravel_index(self.label_inds, shape), 'labels': self.labels,
+               'grid_shape': shape, 'states': self.S, 'trans_n': self.trans_n,
+               'trans_d_full': self.trans_d_full, 'max_iter': max_iter}
+        self.conns = []
+        for (inner, outer, color) in self.shards:
+            conn = self.listener.accept()
+            conn.send(('init', path, inner, outer, cfg))
+            self.conns.append(conn)
+        res = [conn.recv() for conn in self.conns]
+        self.feats = res[0][0]
+        self.shard_sizes = np.array([r[1] for r in res])
+        self.samples = int(np.sum(self.shard_sizes))
+
+        self.init_Q()
+        print('Sharded TCRFR: {0} samples, {1} labels, {2} features, {3} shards at {4}.'.format(
+            self.samples, self.labels.size, self.feats, len(self.shards), self.address))
+
+    def request(self, shards, msgs):
+        """ Send a message to the worker of each shard (in parallel) and return the answers. """
+        for (i, msg) in zip(shards, msgs):
+            self.conns[i].send(msg)
+        return [self.conns[i].recv() for i in shards]
+
+    def get_outer_latent(self, i):
+        outer = self.shards[i][1]
+        return self.latent[outer[0]:outer[1], outer[2]:outer[3], outer[4]:outer[5]].copy()
+
+    def set_inner_latent(self, i, lats):
+        inner = self.shards[i][0]
+        self.latent[inner[0]:inner[1], inner[2]:inner[3], inner[4]:inner[5]] = lats
+
+    def reduce_statistics(self):
+        """ Send the current states to all workers and reduce their sufficient statistics. """
+        shards = range(len(self.shards))
+        res = self.request(shards, [('stats', self.get_outer_latent(i)) for i in shards])
+        psi = np.sum([r[0] for r in res], axis=0)
+        XtX = np.sum([r[1] for r in res], axis=0)
+        Xty = np.sum([r[2] for r in res], axis=0)
+        yty = np.sum([r[3] for r in res])
+        self.stats_regression = (XtX, Xty, yty)
+        self.pl_cache = None
+        return psi
+
+    def map_inference(self, u, vn):
+        # one shard color at a time (see 'get_tiles'), halo states are taken from the last update
+        for color in sorted(set(c for (_, _, c) in self.shards)):
+            shards = [i for i in range(len(self.shards)) if self.shards[i][2] == color]
+            res = self.request(shards, [('map', self.get_outer_latent(i), u, vn, self.reg_theta) for i in shards])
+            for (i, lats) in zip(shards, res):
+                self.set_inner_latent(i, lats)
+        # no joint feature maps, the regression m-step uses the reduced statistics
+        return None, self.reduce_statistics()
+
+    def get_pl_statistics(self, vn):
+        if self.pl_cache is None or not np.array_equal(self.pl_cache[0], vn):
+            shards = range(len(self.shards))
+            res = self.request(shards, [('pl', vn) for i in shards])
+            self.pl_cache = (vn.copy(), np.sum([r[0] for r in res]), np.sum([r[1] for r in res], axis=0))
+        return self.pl_cache[1], self.pl_cache[2]
+
+    def log_partition(self, v):
+        return self.get_pl_statistics(v)[0]
+
+    def log_partition_derivative(self, v):
+        return self.get_pl_statistics(v)[1]
+
+    def em_estimate_v_grad_callback(self, v, psi, boolean):
+        vn = self.unpack_v(v)
+        grad = self.Q.dot(vn) - psi + self.log_partition_derivative(vn)
+        # chain rule of 'unpack_v' (symmetric transition matrices are packed)
+        packed = np.zeros(v.size)
+        cnt = 0
+        cnt_full = 0
+        for i in range(self.trans_n):
+            d_full = int(self.trans_d_full)
+            if self.trans_sym[i] == 1:
+                d_sym = int(self.trans_d_sym)
+                packed[cnt:cnt+d_sym] = self.trans_vec2vec_mtx.T.dot(grad[cnt_full:cnt_full+d_full])
+                cnt += d_sym
+            else:
+                packed[cnt:cnt+d_full] = grad[cnt_full:cnt_full+d_full]
+                cnt += d_full
+            cnt_full += d_full
+        packed[cnt:] = grad[cnt_full:]
+        return packed
+
+    def em_estimate_u_map(self, phis):
+        return self.em_estimate_u()
+
+    def em_estimate_u(self, X=None):
+        # block-diagonal ridge regression on the reduced statistics (one block per state)
+        XtX, Xty, yty = self.stats_regression
+        u = np.zeros(self.S*self.feats)
+        obj = yty / 2.0
+        for s in range(self.S):
+            u_s = np.linalg.solve(XtX[s] + self.reg_lambda*np.eye(self.feats), Xty[s])
+            u[s*self.feats:(s+1)*self.feats] = u_s
+            obj += self.reg_lambda / 2.0 * u_s.dot(u_s) - u_s.dot(Xty[s]) + u_s.dot(XtX[s].dot(u_s)) / 2.0
+        return obj, u
+
+    def get_hotstart(self, use_cache=None, max_samples=100000):
+        # kmeans on a random subset of all shards, all active vertices get the nearest center
+        # (nothing is cached here, 'use_cache' only keeps the 'AbstractTCRFR' signature)
+        import sklearn.cluster as cl
+        sizes = self.shard_sizes
+        counts = np.ceil(max_samples*sizes/float(max(np.sum(sizes), 1))).astype(int)
+        seeds = np.random.randint(0, 2**31-1, size=len(self.shards))
+        shards = range(len(self.shards))
+        X = np.concatenate(self.request(shards, [('sample', counts[i], seeds[i]) for i in shards]))
+        kmeans = cl.KMeans(n_clusters=self.S, init='random', n_init=10, max_iter=100, tol=0.0001)
+        kmeans.fit(X)
+        res = self.request(shards, [('assign', kmeans.cluster_centers_) for i in shards])
+        for (i, lats) in zip(shards, res):
+            self.set_inner_latent(i, lats)
+        psi = self.reduce_statistics()
+        _, v = self.em_estimate_v(np.zeros(self.get_num_compressed_dims()), psi)
+        _, u = self.em_estimate_u()
+        return u, v
+
+    def close(self):
+        """ Stop all workers. """
+        for conn in self.conns:
+            conn.send(('close', ))
+            conn.close()
+        self.listener.close()
+        for worker in self.workers:
+            worker.join()
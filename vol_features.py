@@ -0,0 +1,149 @@
+import numpy as np
+import scipy.sparse as sparse
+
+from graph_builder import get_grid_shape, grid_radius_adjacency, to_cvxopt
+from graph_cache import adjacency_triplets
+from volume import Vol
+
+# "NaN value" of the .vol files (cells outside of the reservoir)
+null_value = -1e+30
+
+
+def vols_to_data(vols, dtype=np.float64):
+    """ (F x N) data matrix of F aligned volumes (e.g. one attribute each) with the
+        vertices numbered as the c-ordered Vol.data array (see 'grid_radius_adjacency').
+        For a single volume the result is a view of its data (if it is contiguous).
+    """
+    shape = vols[0].data.shape
+    for vol in vols:
+        if vol.data.shape != shape:
+            raise ValueError('All volumes need to have the same shape.')
+    if len(vols) == 1:
+        return np.asarray(vols[0].data, dtype=dtype).reshape(1, -1)
+    data = np.empty((len(vols), vols[0].data.size), dtype=dtype)
+    for f in range(len(vols)):
+        data[f, :] = vols[f].data.reshape(-1)
+    return data
+
+
+def flat_to_xyz(grid, inds=None):
+    """ Voxel coordinates (x, y, z) of the flat vertex indices (default: all vertices)
+        of a grid (volume.Vol or (z, y, x) shape).
+    """
+    shape = get_grid_shape(grid)
+    if inds is None:
+        inds = np.arange(shape[0]*shape[1]*shape[2])
+    z, y, x = np.unravel_index(inds, shape)
+    return x, y, z
+
+
+def xyz_to_flat(grid, x, y, z):
+    """ Flat vertex indices of the voxel coordinates (x, y, z). """
+    return np.ravel_multi_index((z, y, x), get_grid_shape(grid))
+
+
+def scatter_to_vol(vol, values, inds=None, fill=null_value):
+    """ New volume with the header of 'vol' where vertex inds[i] (default: all vertices)
+        gets values[i] and all remaining voxels are set to 'fill'.
+    """
+    data = np.empty(vol.data.shape, dtype=np.float64)
+    if inds is None:
+        data.reshape(-1)[:] = values
+    else:
+        data.fill(fill)
+        data.reshape(-1)[inds] = values
+    res = Vol()
+    res.load(vol.sizeX, vol.sizeY, vol.sizeZ, vol.originX, vol.originY, vol.originZ,
+             vol.stepX, vol.stepY, vol.stepZ, vol.rotation, data, copy=False)
+    return res
+
+
+class VolStack(object):
+    """ Aligned (in-memory or memory-mapped) volumes with the box access of
+        vol_store.VolStore, e.g. as data source of 'tcrfr_inference.tiled_map_inference'.
+    """
+    vols = None     # list of aligned volumes
+    shape = None    # (z, y, x) shape of the volumes
+
+    def __init__(self, vols):
+        self.vols = vols
+        self.shape = vols[0].data.shape
+
+    def readBox(self, z0, z1, y0, y1, x0, x1):
+        box = np.empty((len(self.vols), z1-z0, y1-y0, x1-x0), dtype=np.float64)
+        for a in range(len(self.vols)):
+            box[a] = self.vols[a].data[z0:z1, y0:y1, x0:x1]
+        return box
+
+
+class ActiveCells(object):
+    """ Compact numbering of the active cells of a grid, i.e. all voxels that are not
+        'null_value' in any of the aligned volumes. Data, graphs and label indices
+        are restricted to the active cells before they are passed to the TCRFR models
+        and results are scattered back onto the full grid afterwards.
+    """
+    mask = None     # (N bool) 'True':cell is active (N = number of grid cells)
+    inds = None     # (#active) full grid index of each active cell
+    lookup = None   # (N) compact index of each cell (-1:inactive)
+
+    def __init__(self, vols, mask=None):
+        if mask is None:
+            mask = np.ones(vols[0].data.size, dtype=bool)
+            for vol in vols:
+                mask &= vol.data.reshape(-1) > null_value
+        self.mask = np.asarray(mask, dtype=bool).reshape(-1)
+        self.inds = np.where(self.mask)[0]
+        self.lookup = -np.ones(self.mask.size, dtype=np.int64)
+        self.lookup[self.inds] = np.arange(self.inds.size)
+
+    def get_num_active(self):
+        return self.inds.size
+
+    def get_data(self, vols, dtype=np.float64):
+        """ (F x #active) data matrix of the aligned volumes (see 'vols_to_data'). """
+        data = np.empty((len(vols), self.inds.size), dtype=dtype)
+        for f in range(len(vols)):
+            data[f, :] = vols[f].data.reshape(-1)[self.inds]
+        return data
+
+    def get_grid_adjacency(self, grid, radius=1, lateral_etype=1, vertical_etype=None):
+        """ Radius neighborhood graph (see 'grid_radius_adjacency') of the active cells
+            of a grid (volume.Vol or (z, y, x) shape). Edges of inactive cells are
+            never built.
+        """
+        return grid_radius_adjacency(grid, radius, lateral_etype, vertical_etype, mask=self.mask)
+
+    def restrict_adjacency(self, A):
+        """ Adjacency matrix (scipy sparse or cvxopt spmatrix, same type as A)
+            of the active cells given the adjacency matrix A of the full grid.
+        """
+        rows, cols, vals, verts = adjacency_triplets(A)
+        keep = (self.lookup[rows] >= 0) & (self.lookup[cols] >= 0)
+        B = sparse.csr_matrix((vals[keep], (self.lookup[rows[keep]], self.lookup[cols[keep]])),
+                              shape=(self.inds.size, self.inds.size))
+        if sparse.issparse(A):
+            return B
+        return to_cvxopt(B)
+
+    def restrict_labels(self, label_inds, labels):
+        """ Compact label indices and labels, labels of inactive cells are dropped. """
+        label_inds = np.asarray(label_inds, dtype=np.int64)
+        keep = self.mask[label_inds]
+        return self.lookup[label_inds[keep]], np.asarray(labels)[keep]
+
+    def get_unlabeled_inds(self, label_inds):
+        """ Compact indices of all active cells that are not in the (compact) 'label_inds'. """
+        is_lbl = np.zeros(self.inds.size, dtype=bool)
+        is_lbl[label_inds] = True
+        return np.where(~is_lbl)[0]
+
+    def scatter(self, values, fill=null_value):
+        """ Full grid vector with the values of the active cells (e.g. use fill=-1 for latent states). """
+        res = np.empty(self.mask.size, dtype=np.result_type(np.asarray(values), fill))
+        res.fill(fill)
+        res[self.inds] = values
+        return res
+
+    def to_vol(self, vol, values, fill=null_value):
+        """ New volume with the header of 'vol' and the values of the active cells. """
+        return scatter_to_vol(vol, values, self.inds, fill=fill)
@@ -0,0 +1,152 @@
+import os
+import json
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from volume import Vol, VolWriter, headerKeys, defaultFormat
+
+# Version of the chunked store format
+storeVersion = 1
+
+
+# Create a chunked store from a list of aligned volumes (one attribute per volume).
+# All attributes share one chunk grid, i.e. a chunk file holds a block of every attribute.
+def createStore(path, vols, names, chunks=(16, 64, 64), level=6, dtype=np.float64):
+    shape = vols[0].data.shape
+    for vol in vols:
+        if vol.data.shape != shape:
+            raise ValueError('All volumes of a store need to have the same shape.')
+    if not os.path.exists(os.path.join(path, 'chunks')):
+        os.makedirs(os.path.join(path, 'chunks'))
+
+    header = {'version': storeVersion, 'attributes': list(names), 'shape': list(shape),
+              'chunks': list(chunks), 'dtype': np.dtype(dtype).str, 'compression': 'zlib',
+              'vol': dict((key, getattr(vols[0], key)) for key in headerKeys)}
+    # Write the chunks one z-row at a time (works with memory-mapped volumes)
+    for z0 in range(0, shape[0], chunks[0]):
+        z1 = min(z0+chunks[0], shape[0])
+        for y0 in range(0, shape[1], chunks[1]):
+            y1 = min(y0+chunks[1], shape[1])
+            for x0 in range(0, shape[2], chunks[2]):
+                x1 = min(x0+chunks[2], shape[2])
+                block = np.empty((len(vols), z1-z0, y1-y0, x1-x0), dtype=dtype)
+                for a in range(len(vols)):
+                    block[a] = vols[a].data[z0:z1, y0:y1, x0:x1]
+                f = open(getChunkName(path, z0//chunks[0], y0//chunks[1], x0//chunks[2]), 'wb')
+                f.write(zlib.compress(block.tostring(), level))
+                f.close()
+    f = open(os.path.join(path, 'header.json'), 'w')
+    json.dump(header, f, indent=2)
+    f.close()
+    return VolStore(path)
+
+
+# File name of a chunk given its chunk grid coordinates
+def getChunkName(path, iz, iy, ix):
+    return os.path.join(path, 'chunks', '{0}_{1}_{2}.z'.format(iz, iy, ix))
+
+
+# Convert a set of aligned .vol files into a chunked store
+def volToStore(fileNames, names, path, chunks=(16, 64, 64), level=6):
+    vols = []
+    for fileName in fileNames:
+        vol = Vol()
+        vol.read(fileName, mmap=True)
+        vols.append(vol)
+    return createStore(path, vols, names, chunks=chunks, level=level)
+
+
+# Write one attribute of a chunked store as .vol file (streamed, one chunk z-row at a time)
+def storeToVol(path, name, fileName, description, fmt=defaultFormat):
+    store = VolStore(path)
+    writer = VolWriter(fileName, description, store.getHeaderVol(), fmt=fmt)
+    sizeZ, sizeY, sizeX = store.shape
+    z1 = sizeZ
+    while z1 > 0:
+        z0 = max(0, ((z1-1)//store.chunks[0])*store.chunks[0])
+        writer.write(store.readBox(z0, z1, 0, sizeY, 0, sizeX, names=[name])[0])
+        z1 = z0
+    writer.close()
+
+
+# Create a VolStore class
+class VolStore:
+    'Chunked, compressed on-disk store of aligned volumes'
+
+    def __init__(self, path, cacheSize=64):
+        self.path = path
+        f = open(os.path.join(path, 'header.json'), 'r')
+        self.header = json.load(f)
+        f.close()
+        if self.header['version'] != storeVersion:
+            raise ValueError('Unsupported volume store version {0}.'.format(self.header['version']))
+        self.names = self.header['attributes']
+        self.shape = tuple(self.header['shape'])
+        self.chunks = tuple(self.header['chunks'])
+        self.dtype = np.dtype(self.header['dtype'])
+        # Least recently used decompressed chunks
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()
+
+    # Get a decompressed chunk (attributes x z x y x x)
+    def readChunk(self, iz, iy, ix):
+        key = (iz, iy, ix)
+        if key in self.cache:
+            block = self.cache.pop(key)
+            self.cache[key] = block
+            return block
+        z0, y0, x0 = iz*self.chunks[0], iy*self.chunks[1], ix*self.chunks[2]
+        dims = (len(self.names),
+                min(self.chunks[0], self.shape[0]-z0),
+                min(self.chunks[1], self.shape[1]-y0),
+                min(self.chunks[2], self.shape[2]-x0))
+        f = open(getChunkName(self.path, iz, iy, ix), 'rb')
+        block = np.fromstring(zlib.decompress(f.read()), dtype=self.dtype).reshape(dims)
+        f.close()
+        self.cache[key] = block
+        while len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+        return block
+
+    # Read a box [z0,z1) x [y0,y1) x [x0,x1) (voxel coordinates) of some (default: all)
+    # attributes, only the overlapping chunks are decompressed
+    def readBox(self, z0, z1, y0, y1, x0, x1, names=None):
+        if names is None:
+            names = self.names
+        attrs = [self.names.index(name) for name in names]
+        box = np.empty((len(attrs), z1-z0, y1-y0, x1-x0), dtype=self.dtype)
+        cz, cy, cx = self.chunks
+        for iz in range(z0//cz, (z1-1)//cz+1):
+            for iy in range(y0//cy, (y1-1)//cy+1):
+                for ix in range(x0//cx, (x1-1)//cx+1):
+                    block = self.readChunk(iz, iy, ix)
+                    # Overlap of the chunk and the box in volume coordinates
+                    bz0, bz1 = max(z0, iz*cz), min(z1, (iz+1)*cz)
+                    by0, by1 = max(y0, iy*cy), min(y1, (iy+1)*cy)
+                    bx0, bx1 = max(x0, ix*cx), min(x1, (ix+1)*cx)
+                    box[:, bz0-z0:bz1-z0, by0-y0:by1-y0, bx0-x0:bx1-x0] = \
+                        block[attrs, bz0-iz*cz:bz1-iz*cz, by0-iy*cy:by1-iy*cy, bx0-ix*cx:bx1-ix*cx]
+        return box
+
+    # Get a Vol with the header of the full volume but without data
+    def getHeaderVol(self):
+        h = self.header['vol']
+        vol = Vol()
+        vol.setHeader(*[h[key] for key in headerKeys])
+        vol.data = None
+        return vol
+
+    # Get a box of one attribute as Vol (default: the full volume)
+    def getVol(self, name, z0=0, z1=None, y0=0, y1=None, x0=0, x1=None):
+        z1 = self.shape[0] if z1 is None else z1
+        y1 = self.shape[1] if y1 is None else y1
+        x1 = self.shape[2] if x1 is None else x1
+        h = self.header['vol']
+        vol = Vol()
+        data = self.readBox(z0, z1, y0, y1, x0, x1, names=[name])[0]
+        vol.load(x1-x0, y1-y0, z1-z0,
+                 h['originX']+x0*h['stepX'], h['originY']+y0*h['stepY'], h['originZ']+z0*h['stepZ'],
+                 h['stepX'], h['stepY'], h['stepZ'], h['rotation'], data, copy=False)
+        return vol
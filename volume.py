@@ -1,6 +1,7 @@
+import os
+import json
+from multiprocessing import Pool
 import numpy as np
-from PIL import Image
-from matplotlib.pyplot import imshow
 
 # Define a color table
 colorTable = (
@@ -22,58 +23,136 @@ colorTable = (
         (191,0,0,255),     (175,0,0,255),     (159,0,0,255),     (143,0,0,255)
 )
 
+# Header fields of a volume (in the order of the .vol file header)
+headerKeys = ('sizeX', 'sizeY', 'sizeZ', 'originX', 'originY', 'originZ',
+              'stepX', 'stepY', 'stepZ', 'rotation')
+
+# Version of the binary sidecar cache format
+cacheVersion = 1
+
+# Default float format of the voxel values and buffer size for writing .vol files
+defaultFormat = '%.12g'
+bufferSize = 2**22
+
+
+# Color a (sizeY, sizeX) slice through a (colors x 4) uint8 lookup table, values
+# outside of the value range (e.g. the "NaN value" -1e+30) are grey
+def renderSlice(sliceData, valueRange, lut):
+    minValue, maxValue = valueRange
+    scale = (len(lut)-1)/(maxValue-minValue) if maxValue > minValue else 0.0
+    valid = (sliceData >= minValue) & (sliceData <= maxValue)
+    img = np.empty(sliceData.shape+(4,), dtype=np.uint8)
+    img[:] = (128, 128, 128, 255)
+    img[valid] = lut[np.round((sliceData[valid]-minValue)*scale).astype(int)]
+    return img
+
+
+# Write one colored slice as PNG file (worker of Vol.exportSlices)
+def exportSlice(args):
+    fileName, sliceData, valueRange, lut = args
+    from PIL import Image
+    # Flip the rows, plots show the slices with origin='lower'
+    Image.fromarray(np.flipud(renderSlice(sliceData, valueRange, lut)), 'RGBA').save(fileName)
+
+
+# Write a (z, y, x) slab in .vol body order (reversed z, one value per line)
+def writeSlab(f, data, fmt=defaultFormat):
+    lineFmt = fmt+'\n'
+    for z in range(data.shape[0]-1,-1,-1):
+        values = np.ravel(data[z])
+        # A single formatting call per z-slice
+        f.write((lineFmt*values.size) % tuple(values.tolist()))
+
+
 # Create a Vol class
 class Vol:
     'Common base class for all volumes'
+
+    # Cached (min, max) of the valid voxel values, see getValueRange
+    valueRange = None
     
-    # Read data from file
-    def read(self,fileName):
+    # Read data from file (with mmap=True the data is a read-only memory-map of the cache)
+    def read(self, fileName, useCache=True, mmap=False):
+        # Use the binary sidecar cache if it is up to date
+        mmapMode = 'r' if mmap else None
+        if (useCache or mmap) and self.readCache(fileName, mmapMode=mmapMode):
+            return
+
         # Open the file for reading only
         f = open(fileName, 'r')
     
         # Read the file header
         f.readline() # skip the first line
         t1, sizeX, sizeY, sizeZ, originX, originY, originZ, stepX, stepY, stepZ, rotation = (f.readline()).split(' ')
+        f.readline() # skip the 'VValue' line
+
+        # Now read all data from file (bulk parser, one value per line)
+        vol = np.fromstring(f.read(), dtype=np.float64, sep=' ')
         f.close()
-    
-        # Convert strings variables to the correct format
-        self.sizeX = int(sizeX)
-        self.sizeY = int(sizeY)
-        self.sizeZ = int(sizeZ)
-        self.originX = float(originX)
-        self.originY = float(originY)
-        self.originZ = float(originZ)
-        self.stepX = float(stepX)
-        self.stepY = float(stepY)
-        self.stepZ = float(stepZ)
-        self.rotation = float(rotation)
-    
-        # Now read all data from file
-        vol = np.loadtxt(fileName, skiprows=3)
+
+        self.setHeader(sizeX, sizeY, sizeZ, originX, originY, originZ,
+                       stepX, stepY, stepZ, rotation)
         vol = vol.reshape(self.sizeZ,self.sizeY,self.sizeX)
         vol = np.flipud(vol)
         self.data = vol
-        
-        # Set the maximum and minimum voxel and world coordinates
-        self.vMinX = 0
-        self.vMaxX = self.sizeX-1
-        self.vMinY = 0
-        self.vMaxY = self.sizeY-1
-        self.vMinZ = 0
-        self.vMaxZ = self.sizeZ-1
-        self.wminX = self.originX
-        self.wMaxX = self.originX + (self.sizeX)*self.stepX
-        self.wminY = self.originY
-        self.wMaxY = self.originY + (self.sizeY)*self.stepY
-        self.wminZ = self.originZ
-        self.wMaxZ = self.originZ + (self.sizeZ)*self.stepZ
-    
 
-    # Load data to volume structure
-    def load(self,sizeX, sizeY, sizeZ, originX, originY, originZ, 
-             stepX, stepY, stepZ, rotation, data):
-   
-       # Convert variables to the correct format
+        if useCache or mmap:
+            self.writeCache(fileName)
+            if mmap:
+                # Replace the in-memory data by the memory-mapped cache
+                self.readCache(fileName, mmapMode=mmapMode)
+
+
+    # Sidecar cache file names (binary data and header metadata)
+    def getCacheNames(self, fileName):
+        return fileName+'.cache.npy', fileName+'.cache.json'
+
+
+    # Read the binary sidecar cache, returns False if missing or outdated
+    def readCache(self, fileName, mmapMode=None):
+        npyName, jsonName = self.getCacheNames(fileName)
+        if not (os.path.exists(npyName) and os.path.exists(jsonName)):
+            return False
+        f = open(jsonName, 'r')
+        meta = json.load(f)
+        f.close()
+
+        # The cache is only valid for an unchanged source file
+        stat = os.stat(fileName)
+        if (meta.get('version') != cacheVersion or meta['mtime'] != stat.st_mtime
+                or meta['size'] != stat.st_size):
+            return False
+
+        self.setHeader(*[meta[key] for key in headerKeys])
+        self.data = np.load(npyName, mmap_mode=mmapMode)
+        return True
+
+
+    # Write the binary sidecar cache next to the source file
+    def writeCache(self, fileName):
+        npyName, jsonName = self.getCacheNames(fileName)
+        stat = os.stat(fileName)
+        meta = dict((key, getattr(self, key)) for key in headerKeys)
+        meta['version'] = cacheVersion
+        meta['mtime'] = stat.st_mtime
+        meta['size'] = stat.st_size
+        try:
+            # Write temporary files first, other processes might read the cache
+            np.save(npyName+'.tmp.npy', np.ascontiguousarray(self.data))
+            f = open(jsonName+'.tmp', 'w')
+            json.dump(meta, f)
+            f.close()
+            os.rename(npyName+'.tmp.npy', npyName)
+            os.rename(jsonName+'.tmp', jsonName)
+        except (IOError, OSError):
+            print('Could not write the volume cache for '+fileName)
+
+
+    # Set the volume header and the voxel and world coordinate ranges
+    def setHeader(self, sizeX, sizeY, sizeZ, originX, originY, originZ,
+                  stepX, stepY, stepZ, rotation):
+
+        # Convert variables to the correct format
         self.sizeX = int(sizeX)
         self.sizeY = int(sizeY)
         self.sizeZ = int(sizeZ)
@@ -84,8 +163,10 @@ class Vol:
         self.stepY = float(stepY)
         self.stepZ = float(stepZ)
         self.rotation = float(rotation)
-        self.data = np.copy(data)
-        
+
+        # New data, the cached value range is outdated
+        self.valueRange = None
+
         # Set the maximum and minimum voxel and world coordinates
         self.vMinX = 0
         self.vMaxX = self.sizeX-1
@@ -99,28 +180,39 @@ class Vol:
         self.wMaxY = self.originY + (self.sizeY)*self.stepY
         self.wminZ = self.originZ
         self.wMaxZ = self.originZ + (self.sizeZ)*self.stepZ
+
+
+    # Load data to volume structure (copy=False keeps a reference to data)
+    def load(self,sizeX, sizeY, sizeZ, originX, originY, originZ, 
+             stepX, stepY, stepZ, rotation, data, copy=True):
+        self.setHeader(sizeX, sizeY, sizeZ, originX, originY, originZ,
+                       stepX, stepY, stepZ, rotation)
+        if copy:
+            self.data = np.copy(data)
+        else:
+            self.data = data
     
 
-    # Save volume on file
-    def save(self, fileName, description): 
-                      
-        f = open(fileName, 'w')
+    # Write the .vol file header
+    def writeHeader(self, f, description):
         f.write(description)
         f.write("1 "+str(self.sizeX)+" "+str(self.sizeY)+" "+str(self.sizeZ)+" "+
                 '%.6f'% self.originX+" "+'%.6f' % self.originY+" "+'%.6f' % self.originZ+
                 " "+'%.6f' % self.stepX+" "+'%.6f' % self.stepY+" "+'%.6f' % self.stepZ+
                 " "+'%.6f' % self.rotation+"\n")
         f.write('VValue\n')
-        for z in range(self.sizeZ-1,-1,-1):
-            for y in range(self.sizeY):
-                for x in range(self.sizeX):
-                    f.write(str(self.data[z,y,x])+"\n")
+
+
+    # Save volume on file (fmt: float format of the voxel values)
+    def save(self, fileName, description, fmt=defaultFormat):
+        f = open(fileName, 'w', bufferSize)
+        self.writeHeader(f, description)
+        writeSlab(f, self.data, fmt)
         f.close()
              
-    # Generate a sub-volume and save it on file
-    def saveSubVol(self, fileName, description, 
-                   initX, initY, initZ, endX, endY, endZ):
-    
+    # Get a sub-volume in world coordinates (its data is a view, no copy is made)
+    def getSubVol(self, initX, initY, initZ, endX, endY, endZ):
+
         # Define voxel initial coordinates
         init_vx_X = int(round((initX-self.originX)/self.stepX))
         init_vx_Y = int(round((initY-self.originY)/self.stepY))
@@ -128,123 +220,139 @@ class Vol:
         dim_vx_X = abs(int(round((endX-initX+1.)/self.stepX)))
         dim_vx_Y = abs(int(round((endY-initY+1.)/self.stepY)))
         dim_vx_Z = abs(int(round((endZ-initZ+1.)/self.stepZ)))
-    
-        # Generate volumetric data
-        subVol = np.zeros((dim_vx_Z,dim_vx_Y,dim_vx_X))
-        for i in range(dim_vx_Z):
-            for j in range(dim_vx_Y):
-                for k in range(dim_vx_X):
-                    subVol[i,j,k] = self.data[init_vx_Z+i,init_vx_Y+j,init_vx_X+k]
-        subVol = np.flipud(subVol)
-                
-        # Save the sub-volume to fileName
-        f = open(fileName, 'w')
-        f.write(description)
-        f.write("1 "+str(dim_vx_X)+" "+str(dim_vx_Y)+" "+str(dim_vx_Z)+" "+
-                '%.6f' % initX+" "+'%.6f' % initY+" "+'%.6f' % initZ+" "+
-                '%.6f' % self.stepX+" "+'%.6f' % self.stepY+" "+'%.6f' % self.stepZ+
-                " "+'%.6f' % self.rotation+"\n")
-        f.write('VValue\n')
-        for z in range(dim_vx_Z):    
-            for y in range(dim_vx_Y):
-                for x in range(dim_vx_X):
-                    f.write(str(subVol[z,y,x])+"\n")
-        f.close()
+        if (min(init_vx_X, init_vx_Y, init_vx_Z) < 0 or init_vx_X+dim_vx_X > self.sizeX or
+                init_vx_Y+dim_vx_Y > self.sizeY or init_vx_Z+dim_vx_Z > self.sizeZ):
+            raise IndexError('Sub-volume exceeds the volume boundaries.')
+
+        subVol = Vol()
+        subVol.load(dim_vx_X, dim_vx_Y, dim_vx_Z, initX, initY, initZ,
+                    self.stepX, self.stepY, self.stepZ, self.rotation,
+                    self.data[init_vx_Z:init_vx_Z+dim_vx_Z,
+                              init_vx_Y:init_vx_Y+dim_vx_Y,
+                              init_vx_X:init_vx_X+dim_vx_X], copy=False)
+        return subVol
+
+
+    # Generate a sub-volume and save it on file
+    def saveSubVol(self, fileName, description, 
+                   initX, initY, initZ, endX, endY, endZ):
+        subVol = self.getSubVol(initX, initY, initZ, endX, endY, endZ)
+        subVol.save(fileName, description)
  
-     # Get the reservoir Z base coordinates
-    def getResTop(self):
-        refTop = np.zeros((self.sizeX,self.sizeY),dtype=int)
-        for x in range(self.sizeX):
-            for y in range(self.sizeY):
-                for z in range(self.sizeZ):
-                    if self.data[z,y,x] > -1e+30:
-                        refTop[x][y] = z
-                        break
-        return refTop
-
-
-    # Get the reservoir Z top coordinates
-    def getResBase(self):
-        refBase = np.zeros((self.sizeX,self.sizeY),dtype=int)
-        for x in range(self.sizeX):
-            for y in range(self.sizeY):
-                for z in range(self.sizeZ-1,-1,-1):
-                    if self.data[z,y,x] > -1e+30:
-                        refBase[x][y] = z
-                        break
-        return refBase
+    # Get the validity mask of the voxels (False for the "NaN value" -1e+30)
+    def getValidMask(self):
+        return self.data > -1e+30
+
+
+    # Get the reservoir Z top coordinates (first valid z of each column, 0 if none)
+    def getResTop(self, valid=None):
+        if valid is None:
+            valid = self.getValidMask()
+        return np.argmax(valid, axis=0).T
+
+
+    # Get the reservoir Z base coordinates (last valid z of each column, 0 if none)
+    def getResBase(self, valid=None):
+        if valid is None:
+            valid = self.getValidMask()
+        refBase = self.sizeZ-1-np.argmax(valid[::-1], axis=0)
+        refBase[~np.any(valid, axis=0)] = 0
+        return refBase.T
+
+
+    # Get the z indices (sizeY, sizeX) of the slice with d% distance from the bottom of
+    # the reservoir, d can be an array of distances (result is then (len(d), sizeY, sizeX))
+    def getStratIndices(self, d, refTop=None, refBase=None):
+        if refTop is None or refBase is None:
+            valid = self.getValidMask()
+            refTop = self.getResTop(valid)
+            refBase = self.getResBase(valid)
+        d = np.asarray(d, dtype=np.float64)
+        l = (refBase-refTop).T
+        d = d.reshape(d.shape+(1, 1))
+        return (refBase.T-np.floor(d*l+0.5)).astype(int)
+
+
+    # Get the slice (sizeY, sizeX) with d% distance from the bottom of the reservoir
+    def getStratSlice(self, d, refTop=None, refBase=None):
+        z = self.getStratIndices(d, refTop, refBase)
+        return self.data[z, np.arange(self.sizeY)[:, np.newaxis], np.arange(self.sizeX)]
+
+
+    # Get the flattened stratigraphic grid (nLayers, sizeY, sizeX) where each column is
+    # resampled between reservoir top (layer 0) and base (layer nLayers-1)
+    def getStratGrid(self, nLayers, refTop=None, refBase=None):
+        d = 1.0-np.linspace(0.0, 1.0, nLayers)
+        return self.getStratSlice(d, refTop, refBase)
+
+
+    # Get the minimum and maximum values excluding the "NaN value" -1e+30 (cached)
+    def getValueRange(self):
+        if self.valueRange is None:
+            values = self.data[self.getValidMask()]
+            if values.size == 0:
+                self.valueRange = (0.0, 0.0)
+            else:
+                self.valueRange = (float(values.min()), float(values.max()))
+        return self.valueRange
+
+
+    # Get the RGBA image (sizeY, sizeX, 4) of a (sizeY, sizeX) slice
+    def getSliceImage(self, sliceData, color_table=colorTable):
+        return renderSlice(sliceData, self.getValueRange(), np.array(color_table, dtype=np.uint8))
 
 
-    # Plot a slice from the volume with d% distance from the bottom of the reservoir
-    def plotSlice(self, d, color_table=colorTable):
-    
-        # Get the maximum and minimum values, excluding the "NaN value" (-1e+30)
-        aux = np.sort(np.unique(self.data))
-        minValue = aux[0]
-        if minValue == -1e+30:
-            minValue = aux[1]
-        maxValue = aux[-1]
-
-        # Define min and max color indexes
-        minIndex = 0
-        maxIndex = len(color_table)-1
-    
-        # Generate the color index volume
-        vol_color = np.zeros((self.sizeZ, self.sizeY, self.sizeX), dtype=int)
-        vol_color = np.round((self.data-minValue)/(maxValue-minValue)*(maxIndex-minIndex)+minIndex).astype(int)
-        
-        # Get the reservoir z top coordinates
-        refZT = self.getResTop()
-                     
-        # Get the reservoir z base coordinates
-        refZB = self.getResBase()
-
-        # Create and display image
-        img = Image.new( 'RGBA', (self.sizeX,self.sizeY), "grey") # create a new grey image
-        pixels = img.load() # create the pixel map
-
-        print img.size[0],img.size[1]
-
-        for i in range(img.size[0]):  # for every pixel
-            for j in range(img.size[1]):
-                l = refZB[i][j]-refZT[i][j]
-                z =refZB[i][j]-int(round(d*l))
-                if vol_color[z,j,i] >= 0:
-                    pixels[i,j] = (color_table[vol_color[z,j,i]][0],
-                                   color_table[vol_color[z,j,i]][1],
-                                   color_table[vol_color[z,j,i]][2],
-                                   color_table[vol_color[z,j,i]][3])
-        imshow(np.array(img), origin='lower')
-        
-        
     # Plot a slice from the volume
     def plotSlice(self, sliceNumber, color_table=colorTable):
-    
-        # Get the maximum and minimum values, excluding the "NaN value" (-1e+30)
-        aux = np.sort(np.unique(self.data))
-        minValue = aux[0]
-        if minValue == -1e+30:
-            minValue = aux[1]
-        maxValue = aux[-1]
-
-        # Define min and max color indexes
-        minIndex = 0
-        maxIndex = len(color_table)-1
-    
-        # Generate the color index volume
-        vol_color = np.zeros((self.sizeZ, self.sizeY, self.sizeX), dtype=int)
-        vol_color = np.round((self.data-minValue)/(maxValue-minValue)*(maxIndex-minIndex)+
-                    minIndex).astype(int)
-        
-         # Create and display image
-        img = Image.new( 'RGBA', (self.sizeX,self.sizeY), "grey") # create a new grey image
-        pixels = img.load() # create the pixel map
-
-        for i in range(img.size[0]):  # for every pixel
-            for j in range(img.size[1]):
-                if vol_color[sliceNumber,j,i] >= 0:
-                    pixels[i,j] = (color_table[vol_color[sliceNumber,j,i]][0],
-                                   color_table[vol_color[sliceNumber,j,i]][1],
-                                   color_table[vol_color[sliceNumber,j,i]][2],
-                                   color_table[vol_color[sliceNumber,j,i]][3])
-        imshow(np.array(img), origin='lower')        
+        from matplotlib.pyplot import imshow
+        imshow(self.getSliceImage(self.data[sliceNumber], color_table), origin='lower')
+
+
+    # Plot a slice from the volume with d% distance from the bottom of the reservoir
+    def plotStratSlice(self, d, color_table=colorTable):
+        from matplotlib.pyplot import imshow
+        imshow(self.getSliceImage(self.getStratSlice(d), color_table), origin='lower')
+
+
+    # Export every z-slice as PNG file, fileNames is a pattern such as 'slice_{0:04d}.png'
+    def exportSlices(self, fileNames, color_table=colorTable, processes=None):
+        lut = np.array(color_table, dtype=np.uint8)
+        valueRange = self.getValueRange()
+        tasks = ((fileNames.format(z), np.array(self.data[z]), valueRange, lut)
+                 for z in range(self.sizeZ))
+        pool = Pool(processes=processes)
+        try:
+            # imap keeps only a few slices in flight
+            for _ in pool.imap(exportSlice, tasks):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+
+
+# Streaming writer for .vol files: z-slabs (nz, sizeY, sizeX) are written as they are
+# produced, starting with the top-most slab (highest z) and moving downwards
+class VolWriter:
+    'Streaming .vol file writer'
+
+    def __init__(self, fileName, description, vol, fmt=defaultFormat):
+        # The volume 'vol' only provides the header, its data is not touched
+        self.vol = vol
+        self.fmt = fmt
+        self.remainingZ = vol.sizeZ
+        self.f = open(fileName, 'w', bufferSize)
+        vol.writeHeader(self.f, description)
+
+    # Write the slab covering z = remainingZ-nz,...,remainingZ-1
+    def write(self, slab):
+        slab = np.asarray(slab).reshape(-1, self.vol.sizeY, self.vol.sizeX)
+        if slab.shape[0] > self.remainingZ:
+            raise ValueError('More slabs than z-levels in the volume.')
+        writeSlab(self.f, slab, self.fmt)
+        self.remainingZ -= slab.shape[0]
+
+    def close(self):
+        self.f.close()
+        if self.remainingZ != 0:
+            raise ValueError('Volume is incomplete, {0} z-levels are missing.'.format(self.remainingZ))